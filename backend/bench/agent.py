@@ -0,0 +1,32 @@
+"""Runs one scan of scan_root in this process and prints its stats as JSON, started by bench.run"""
+import json
+import resource
+import time
+
+import watch
+
+
+def main():
+    start = time.monotonic()
+    stats = watch.scan_home_directory()
+    # Scan uploads go through the outbox, the scan is done once the backend has them all
+    watch.get_outbox().wait_drained()
+    elapsed = time.monotonic() - start
+
+    # ru_maxrss is in KiB on Linux, the hashing pool shows up as children
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+    print(json.dumps({
+        "files": stats.files,
+        "failed": stats.failed,
+        "bytes": stats.bytes,
+        "read_bytes": stats.read_bytes,
+        "seconds": elapsed,
+        "files_per_s": stats.files / elapsed,
+        "mb_per_s": stats.bytes / (1024 * 1024) / elapsed,
+        "peak_rss": peak_rss
+    }))
+
+
+if __name__ == '__main__':
+    main()
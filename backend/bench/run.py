@@ -0,0 +1,178 @@
+"""Benchmark the scanner and the API against a local main.py
+
+Run from the backend directory:
+
+    python -m bench.run --files 20000 --output results.json
+
+A synthetic tree is generated in a temporary directory, main.py is started
+on its own SQLite file and the agent scans the tree twice (cold, then with
+a warm hash cache). Endpoint latencies are measured afterwards. Results are
+written as JSON together with the git commit, so runs on different commits
+can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import requests
+
+from bench.tree import generate_tree
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss(pid):
+    """VmHWM of a running process in bytes, None where /proc isn't available"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+
+
+def start_server(workdir, port):
+    env = dict(os.environ, database_url=f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    server = subprocess.Popen([sys.executable, "-m", "flask", "--app", "main", "run", "--port", str(port)],
+                              cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(url + "/stats/shiv", timeout=1)
+            return server, url
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("main.py did not start")
+
+
+def run_agent(workdir, tree, url, args):
+    env = dict(os.environ,
+               api_url=url,
+               scan_root=tree,
+               caption_backend="stub",
+               hash_cache=os.path.join(workdir, "hash_cache.db"),
+               caption_queue=os.path.join(workdir, "captions.db"),
+               drive_state=os.path.join(workdir, "drive_uploads.db"),
+               PYTHONPATH=BACKEND_DIR)
+    if args.hash_workers:
+        env["hash_workers"] = str(args.hash_workers)
+    if args.staged_dedupe:
+        env["staged_dedupe"] = "1"
+    if args.full_scan:
+        env["reconcile"] = "0"
+    # The bench server counts as foreground work, the governor would slow the scan down for it
+    env["governor"] = "1" if args.governor else "0"
+    output = subprocess.check_output([sys.executable, "-m", "bench.agent"], cwd=workdir, env=env, text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def time_requests(session, method, url, count, body=None):
+    samples = []
+    for i in range(count):
+        payload = body(i) if callable(body) else body
+        start = time.perf_counter()
+        response = session.request(method, url, json=payload, timeout=60)
+        response.content
+        samples.append((time.perf_counter() - start) * 1000)
+    return {"count": count, "p50_ms": percentile(samples, 50), "p99_ms": percentile(samples, 99),
+            "max_ms": max(samples)}
+
+
+def measure_endpoints(url, count):
+    session = requests.Session()
+    upload = lambda i: {
+        "device_id": "device_002", "username": "shiv", "name": f"bench{i}.bin",
+        "path": f"/bench/{uuid.uuid4().hex}.bin", "size": 1024, "hash": uuid.uuid4().hex * 2,
+        "category": "others", "last_access": "2024-01-01T00:00:00"
+    }
+    return {
+        "/upload": time_requests(session, "POST", url + "/upload", count, upload),
+        "/stats/<user>": time_requests(session, "GET", url + "/stats/shiv", count),
+        "/files?limit=100": time_requests(session, "GET", url + "/files?limit=100", count),
+        "/files": time_requests(session, "GET", url + "/files", max(1, count // 10)),
+        "/image/search": time_requests(session, "GET", url + "/image/search/image", count),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--median-kib", type=int, default=64)
+    parser.add_argument("--sigma", type=float, default=1.5)
+    parser.add_argument("--max-mib", type=int, default=256)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1)
+    parser.add_argument("--image-share", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--hash-workers", type=int)
+    parser.add_argument("--staged-dedupe", action="store_true")
+    parser.add_argument("--full-scan", action="store_true", help="walk and send every file instead of reconciling")
+    parser.add_argument("--governor", action="store_true", help="let the resource governor throttle the scan")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="sfo-bench-") as workdir:
+        tree = os.path.join(workdir, "tree")
+        start = time.monotonic()
+        summary = generate_tree(tree, files=args.files, median_kib=args.median_kib, sigma=args.sigma,
+                                max_mib=args.max_mib, duplicate_ratio=args.duplicate_ratio,
+                                image_share=args.image_share, seed=args.seed)
+        summary["seconds"] = time.monotonic() - start
+
+        server, url = start_server(workdir, free_port())
+        try:
+            # clean_on_scan would delete the generated duplicates between runs
+            requests.post(url + "/update_cleaning", json={"username": "shiv", "clean_on_scan": False}, timeout=5)
+            cold = run_agent(workdir, tree, url, args)
+            warm = run_agent(workdir, tree, url, args)
+            endpoints = measure_endpoints(url, args.requests)
+            server_rss = peak_rss(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "params": vars(args),
+        "tree": summary,
+        "scan_cold": cold,
+        "scan_warm": warm,
+        "endpoints": endpoints,
+        "server_peak_rss": server_rss,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Synthetic file trees for the scanner benchmarks"""
+import os
+import random
+import shutil
+
+from PIL import Image
+
+
+def generate_tree(root, files=10000, median_kib=64, sigma=1.5, max_mib=256, duplicate_ratio=0.1,
+                  image_share=0.2, files_per_dir=200, seed=0):
+    """Write `files` files under root and return a summary of what was written
+
+    Sizes follow a log-normal distribution around median_kib, capped at
+    max_mib. duplicate_ratio of the files are byte for byte copies of
+    earlier ones and image_share of the rest are small random PNG/JPEG
+    images, so every image has its own perceptual hash.
+    """
+    rng = random.Random(seed)
+    os.makedirs(root, exist_ok=True)
+    written = []
+    summary = {"files": 0, "bytes": 0, "duplicates": 0, "images": 0}
+
+    for index in range(files):
+        directory = os.path.join(root, f"d{index // files_per_dir:04d}")
+        os.makedirs(directory, exist_ok=True)
+
+        if written and rng.random() < duplicate_ratio:
+            source = rng.choice(written)
+            path = os.path.join(directory, f"dup{index}{os.path.splitext(source)[1]}")
+            shutil.copyfile(source, path)
+            summary["duplicates"] += 1
+        elif rng.random() < image_share:
+            ext = rng.choice([".png", ".jpg"])
+            path = os.path.join(directory, f"img{index}{ext}")
+            side = rng.randint(64, 512)
+            Image.frombytes("RGB", (side, side), rng.randbytes(side * side * 3)).save(path)
+            summary["images"] += 1
+        else:
+            size = min(int(rng.lognormvariate(0, sigma) * median_kib * 1024), max_mib * 1024 * 1024)
+            path = os.path.join(directory, f"file{index}{rng.choice(['.bin', '.txt', '.pdf', '.mp4', '.zip'])}")
+            with open(path, "wb") as f:
+                remaining = size
+                while remaining > 0:
+                    chunk = rng.randbytes(min(remaining, 1024 * 1024))
+                    f.write(chunk)
+                    remaining -= len(chunk)
+
+        written.append(path)
+        summary["files"] += 1
+        summary["bytes"] += os.path.getsize(path)
+
+    return summary
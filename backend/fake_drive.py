@@ -0,0 +1,99 @@
+"""Minimal in-memory stand-in for the Google Drive upload API, for tests
+
+Implements what DriveUploader uses: resumable sessions, chunked PUTs with
+Content-Range, status queries and the files.list search on the sha256
+appProperty. Point the agent at it with drive_fake_url:
+
+    python fake_drive.py 8080
+    drive_fake_url=http://127.0.0.1:8080 python watch.py
+"""
+import re
+import sys
+import threading
+import uuid
+
+from flask import Flask, request, jsonify, Response
+
+
+def create_app():
+    app = Flask(__name__)
+    lock = threading.Lock()
+    sessions = {}  # upload id -> {"name", "app_properties", "size", "data"}
+    files = {}     # file id -> {"name", "app_properties", "data"}
+
+    def received_range(data):
+        # 308 "Resume Incomplete", Range tells the client how many bytes are stored
+        response = Response(status=308)
+        if data:
+            response.headers["Range"] = f"bytes=0-{len(data) - 1}"
+        return response
+
+    def finish(session):
+        file_id = uuid.uuid4().hex
+        files[file_id] = {"name": session["name"], "app_properties": session["app_properties"],
+                          "data": bytes(session["data"])}
+        session["file_id"] = file_id
+        return jsonify({"id": file_id})
+
+    @app.route('/upload/drive/v3/files', methods=['POST'])
+    def start_upload():
+        if request.args.get("uploadType") != "resumable":
+            return jsonify({"error": "Only resumable uploads are supported"}), 400
+        metadata = request.get_json(silent=True) or {}
+        upload_id = uuid.uuid4().hex
+        with lock:
+            sessions[upload_id] = {"name": metadata.get("name"), "app_properties": metadata.get("appProperties", {}),
+                                   "size": int(request.headers["X-Upload-Content-Length"]),
+                                   "data": bytearray(), "file_id": None}
+        response = jsonify({})
+        response.headers["Location"] = f"{request.host_url}upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+        return response
+
+    @app.route('/upload/drive/v3/files', methods=['PUT'])
+    def upload_chunk():
+        upload_id = request.args.get("upload_id")
+        match = re.fullmatch(r"bytes (?:(\d+)-(\d+)|\*)/(\d+)", request.headers.get("Content-Range", ""))
+        with lock:
+            session = sessions.get(upload_id)
+            if session is None:
+                return jsonify({"error": "Upload session not found"}), 404
+            if not match or int(match.group(3)) != session["size"]:
+                return jsonify({"error": "Invalid Content-Range"}), 400
+            if session["file_id"]:
+                return jsonify({"id": session["file_id"]})
+
+            data = session["data"]
+            if match.group(1) is not None:
+                start, end = int(match.group(1)), int(match.group(2))
+                body = request.get_data()
+                if len(body) != end - start + 1:
+                    return jsonify({"error": "Body does not match Content-Range"}), 400
+                # Bytes the server already has are dropped, a gap is refused like Drive does
+                if start > len(data):
+                    return received_range(data)
+                data.extend(body[len(data) - start:])
+            if len(data) == session["size"]:
+                return finish(session)
+            return received_range(data)
+
+    @app.route('/drive/v3/files', methods=['GET'])
+    def list_files():
+        wanted = re.search(r"key='sha256' and value='([0-9a-f]+)'", request.args.get("q", ""))
+        with lock:
+            found = [{"id": file_id} for file_id, f in files.items()
+                     if wanted and f["app_properties"].get("sha256") == wanted.group(1)]
+        return jsonify({"files": found})
+
+    @app.route('/drive/v3/files/<file_id>', methods=['GET'])
+    def download_file(file_id):
+        with lock:
+            f = files.get(file_id)
+        if f is None:
+            return jsonify({"error": "File not found"}), 404
+        return Response(f["data"], mimetype="application/octet-stream")
+
+    return app
+
+
+if __name__ == '__main__':
+    create_app().run(host="127.0.0.1", port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
@@ -0,0 +1,76 @@
+import os
+import threading
+
+import pytest
+import requests
+from werkzeug.serving import make_server
+
+import watch
+from fake_drive import create_app
+
+CHUNK = 256 * 1024
+
+
+class RecordingSession(requests.Session):
+    """Records (method, Content-Range) of every request, raises after `fail_after` chunk PUTs"""
+
+    def __init__(self, log, fail_after=None):
+        super().__init__()
+        self.log = log
+        self.fail_after = fail_after
+
+    def request(self, method, url, *args, headers=None, data=None, **kwargs):
+        if method == "PUT" and data:
+            if self.fail_after is not None and sum(1 for m, r in self.log if m == "PUT" and "*" not in r) >= self.fail_after:
+                raise RuntimeError("agent killed mid-upload")
+        self.log.append((method, (headers or {}).get("Content-Range", "")))
+        return super().request(method, url, *args, headers=headers, data=data, **kwargs)
+
+
+@pytest.fixture
+def drive():
+    server = make_server("127.0.0.1", 0, create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def hash_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(watch, "hash_cache", watch.HashCache(str(tmp_path / "hash_cache.db")))
+
+
+def uploader(drive, state_path, log, fail_after=None):
+    return watch.DriveUploader(session_factory=lambda: RecordingSession(log, fail_after),
+                               upload_url=drive + "/upload/drive/v3/files", files_url=drive + "/drive/v3/files",
+                               chunk_size=CHUNK, state_path=state_path)
+
+
+def test_interrupted_upload_resumes_from_persisted_session(drive, tmp_path):
+    content = os.urandom(2 * CHUNK + 1000)
+    path = tmp_path / "report.bin"
+    path.write_bytes(content)
+    state_path = str(tmp_path / "drive_uploads.db")
+
+    first = []
+    with pytest.raises(RuntimeError):
+        uploader(drive, state_path, first, fail_after=1).upload(str(path))
+    assert [m for m, _ in first].count("POST") == 1
+    assert ("PUT", f"bytes 0-{CHUNK - 1}/{len(content)}") in first
+
+    # A new process with the same state file asks the stored session for its offset and sends only the rest
+    second = []
+    file_id = uploader(drive, state_path, second).upload(str(path))
+    assert "POST" not in [m for m, _ in second]
+    assert second[1:] == [("PUT", f"bytes */{len(content)}"),
+                          ("PUT", f"bytes {CHUNK}-{2 * CHUNK - 1}/{len(content)}"),
+                          ("PUT", f"bytes {2 * CHUNK}-{len(content) - 1}/{len(content)}")]
+    assert requests.get(f"{drive}/drive/v3/files/{file_id}").content == content
+
+    # Same content under another path, or with a fresh state file, is found by its hash and not sent again
+    copy = tmp_path / "copy.bin"
+    copy.write_bytes(content)
+    third = []
+    assert uploader(drive, state_path, third).upload(str(copy)) == file_id
+    assert uploader(drive, str(tmp_path / "fresh.db"), third).upload(str(copy)) == file_id
+    assert [m for m, _ in third] == ["GET"]
@@ -9,11 +9,28 @@ from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from google import genai
 from google.genai import types
-import imagehash
+import numpy
+import scipy.fftpack
 from PIL import Image
 import PIL
 from dotenv import load_dotenv
 import threading
+import queue
+from collections import namedtuple
+import sqlite3
+import zlib
+import shutil
+import subprocess
+import multiprocessing
+from contextlib import contextmanager
+import metrics
+from metrics import REGISTRY, SamplingProfiler
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import zstandard  # optional, archives fall back to gzip without it
+except ImportError:
+    zstandard = None
 
 load_dotenv()
 geminkey = os.getenv("gemini_key")
@@ -21,11 +38,18 @@ geminkey = os.getenv("gemini_key")
 
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from google.auth.transport.requests import AuthorizedSession, Request
 
 SCOPES = ['https://www.googleapis.com/auth/drive.file']  # Modify scope if needed
 
+# Drive uploads, drive_fake_url points both endpoints at a local fake server without auth
+DRIVE_FAKE_URL = os.getenv("drive_fake_url")
+DRIVE_UPLOAD_URL = (DRIVE_FAKE_URL or "https://www.googleapis.com") + "/upload/drive/v3/files"
+DRIVE_FILES_URL = (DRIVE_FAKE_URL or "https://www.googleapis.com") + "/drive/v3/files"
+DRIVE_CHUNK_SIZE = int(os.getenv("drive_chunk_mib", 32)) * 1024 * 1024  # must be a multiple of 256 KiB
+DRIVE_STATE_PATH = os.getenv("drive_state", "drive_uploads.db")
+DRIVE_RETRIES = 5
+
 def authenticate_drive():
     creds = None
 
@@ -33,6 +57,9 @@ def authenticate_drive():
     if os.path.exists("token.json"):
         creds = Credentials.from_authorized_user_file("token.json", SCOPES)
 
+    if creds and creds.expired and creds.refresh_token:
+        creds.refresh(Request())
+
     # If no valid credentials, request authentication
     if not creds or not creds.valid:
         flow = InstalledAppFlow.from_client_secrets_file("/home/shiv/programming/hackathon/smart-file-organiser/client_secret_420192572773-igkcgfbj8i3f4audaolfebnoaj0fiaqe.apps.googleusercontent.com.json", SCOPES)
@@ -46,24 +73,217 @@ def authenticate_drive():
 
     return creds
 
-def upload_file(file_path):
-    creds = authenticate_drive()
-    service = build('drive', 'v3', credentials=creds)
+class DriveUploader:
+    """Long-lived, thread safe Google Drive uploader
+
+    Credentials are loaded once and shared; every thread gets its own HTTP
+    session. Files go up through the resumable upload protocol in
+    DRIVE_CHUNK_SIZE chunks, and the session URI is stored in drive_state so
+    an interrupted upload continues from the last confirmed byte. Uploads
+    are tagged with the file's SHA-256 and skipped when that content is
+    already on Drive.
+    """
+
+    def __init__(self, session_factory=None, upload_url=DRIVE_UPLOAD_URL, files_url=DRIVE_FILES_URL,
+                 chunk_size=DRIVE_CHUNK_SIZE, state_path=DRIVE_STATE_PATH):
+        if session_factory is None:
+            creds = authenticate_drive()
+            session_factory = lambda: AuthorizedSession(creds)
+        self.session_factory = session_factory
+        self.upload_url = upload_url
+        self.files_url = files_url
+        self.chunk_size = chunk_size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(state_path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                uri TEXT NOT NULL
+            )""")
+        self.db.execute("CREATE TABLE IF NOT EXISTS uploaded (sha256 TEXT PRIMARY KEY, file_id TEXT NOT NULL)")
+        self.db.commit()
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = self.session_factory()
+        return self.local.session
+
+    def upload(self, file_path):
+        """Upload one file, returns its Drive file id"""
+        with DRIVE_UPLOAD_SECONDS.time():
+            return self._upload(file_path)
+
+    def _upload(self, file_path):
+        stat_info = os.stat(file_path)
+        sha256 = content_hash(file_path, stat_info)
+
+        existing = self.find_uploaded(sha256)
+        if existing:
+            logging.info(f"Already on Drive, skipped upload: {file_path} ({existing})")
+            return existing
+
+        for attempt in range(DRIVE_RETRIES):
+            try:
+                uri = self.resume_uri(file_path, stat_info, sha256) or self.start(file_path, stat_info, sha256)
+                file_id = self.send(uri, file_path, stat_info.st_size)
+                if file_id is None:
+                    # Session expired on the server, start a new one
+                    self.forget_session(file_path)
+                    continue
+                break
+            except (requests.exceptions.RequestException, ConnectionError) as e:
+                logging.error(f"Drive upload of {file_path} interrupted ({e}), retrying")
+                time.sleep(min(2 ** attempt, 30))
+        else:
+            raise RuntimeError(f"Drive upload of {file_path} failed after {DRIVE_RETRIES} attempts")
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO uploaded (sha256, file_id) VALUES (?, ?)", (sha256, file_id))
+            self.db.execute("DELETE FROM sessions WHERE path = ?", (file_path,))
+            self.db.commit()
+        print(f"File uploaded successfully! File ID: {file_id}")
+        return file_id
+
+    def find_uploaded(self, sha256):
+        with self.lock:
+            row = self.db.execute("SELECT file_id FROM uploaded WHERE sha256 = ?", (sha256,)).fetchone()
+        if row:
+            return row[0]
+        response = self.session().get(self.files_url, params={
+            "q": f"appProperties has {{ key='sha256' and value='{sha256}' }} and trashed = false",
+            "fields": "files(id)",
+            "spaces": "drive"
+        }, timeout=30)
+        if response.status_code == 200 and response.json().get("files"):
+            return response.json()["files"][0]["id"]
+        return None
+
+    def resume_uri(self, file_path, stat_info, sha256):
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, sha256, uri FROM sessions WHERE path = ?",
+                                  (file_path,)).fetchone()
+        if row and row[:3] == (stat_info.st_size, stat_info.st_mtime_ns, sha256):
+            return row[3]
+        return None
 
-    file_metadata = {'name': os.path.basename(file_path)}
-    media = MediaFileUpload(file_path, resumable=True)
+    def forget_session(self, file_path):
+        with self.lock:
+            self.db.execute("DELETE FROM sessions WHERE path = ?", (file_path,))
+            self.db.commit()
+
+    def start(self, file_path, stat_info, sha256):
+        response = self.session().post(self.upload_url, params={"uploadType": "resumable", "fields": "id"}, json={
+            "name": os.path.basename(file_path),
+            "appProperties": {"sha256": sha256}
+        }, headers={"X-Upload-Content-Length": str(stat_info.st_size)}, timeout=30)
+        response.raise_for_status()
+        uri = response.headers["Location"]
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO sessions (path, size, mtime_ns, sha256, uri) VALUES (?, ?, ?, ?, ?)",
+                            (file_path, stat_info.st_size, stat_info.st_mtime_ns, sha256, uri))
+            self.db.commit()
+        return uri
+
+    def uploaded_offset(self, uri, size):
+        """Ask the session how many bytes it has, None when it is already complete"""
+        response = self.session().put(uri, headers={"Content-Range": f"bytes */{size}"}, timeout=30)
+        if response.status_code in (200, 201):
+            return None, response.json()["id"]
+        if response.status_code in (404, 410):
+            return -1, None
+        if response.status_code != 308:
+            response.raise_for_status()
+        received = response.headers.get("Range")
+        return (int(received.rsplit("-", 1)[1]) + 1 if received else 0), None
+
+    def send(self, uri, file_path, size):
+        """Send the file from the session's current offset, returns the file id or None if the session is gone"""
+        offset, file_id = self.uploaded_offset(uri, size)
+        if file_id:
+            return file_id
+        if offset < 0:
+            return None
+
+        with open(file_path, "rb") as f:
+            while True:
+                f.seek(offset)
+                chunk = f.read(self.chunk_size)
+                end = offset + len(chunk) - 1
+                content_range = f"bytes {offset}-{end}/{size}" if chunk else f"bytes */{size}"
+                response = self.session().put(uri, data=chunk, headers={"Content-Range": content_range}, timeout=300)
+                if response.status_code in (200, 201):
+                    return response.json()["id"]
+                if response.status_code in (404, 410):
+                    return None
+                if response.status_code != 308:
+                    response.raise_for_status()
+                received = response.headers.get("Range")
+                offset = int(received.rsplit("-", 1)[1]) + 1 if received else 0
+
+
+drive_uploader = None
+drive_uploader_lock = threading.Lock()
+
+
+def get_drive_uploader():
+    global drive_uploader
+    with drive_uploader_lock:
+        if drive_uploader is None:
+            drive_uploader = DriveUploader(session_factory=requests.Session if DRIVE_FAKE_URL else None)
+        return drive_uploader
 
-    file = service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-    print(f"File uploaded successfully! File ID: {file.get('id')}")
+
+def upload_file(file_path):
+    return get_drive_uploader().upload(file_path)
 
 
 logging.basicConfig(filename="scanner.log", level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 # API Config
-API_URL = "http://192.168.134.67:5000"  
+API_URL = os.getenv("api_url", "http://192.168.134.67:5000")  
 DEVICE_ID = "device_002" 
 USERNAME = "shiv"  
 
+# Metrics, metrics_port serves /metrics, profile_output writes a folded stack profile of each scan
+METRICS_PORT = os.getenv("metrics_port")
+PROFILE_OUTPUT = os.getenv("profile_output")
+
+WALK_DIR_SECONDS = REGISTRY.histogram("agent_walk_dir_seconds", "Time to list one directory")
+STAT_SECONDS = REGISTRY.histogram("agent_stat_seconds", "Time to stat one file")
+HASH_SECONDS = REGISTRY.histogram("agent_hash_seconds", "Time to hash one file or batch, by kind")
+API_SECONDS = REGISTRY.histogram("agent_api_request_seconds", "Time per request to the backend, by endpoint")
+API_ERRORS = REGISTRY.counter("agent_api_errors_total", "Failed requests to the backend, by endpoint")
+CAPTION_SECONDS = REGISTRY.histogram("agent_caption_seconds", "Time per model caption call")
+DRIVE_UPLOAD_SECONDS = REGISTRY.histogram("agent_drive_upload_seconds", "Time per Drive upload, skipped ones included")
+SCAN_FILES = REGISTRY.counter("agent_scan_files_total", "Files scanned")
+SCAN_READ_BYTES = REGISTRY.counter("agent_scan_read_bytes_total", "Bytes read while hashing")
+TASK_QUEUE_DEPTH = REGISTRY.gauge("agent_task_queue_depth", "Tasks waiting for a worker, by action")
+TASK_SECONDS = REGISTRY.histogram("agent_task_seconds", "Time per task, by action")
+GOVERNOR_FACTOR = REGISTRY.gauge("agent_governor_factor", "Share of the base rates background work may use")
+GOVERNOR_LIMIT = REGISTRY.gauge("agent_governor_limit", "Rate background work is held to, 0 if unlimited, by resource")
+GOVERNOR_FOREGROUND = REGISTRY.gauge("agent_governor_foreground", "CPU and disk busy share of other processes, by resource")
+
+
+def api_post(path, **kwargs):
+    with API_SECONDS.time(endpoint=path):
+        try:
+            return requests.post(API_URL+path, **kwargs)
+        except requests.exceptions.RequestException:
+            API_ERRORS.inc(endpoint=path)
+            raise
+
+
+def timed_call(func, *args):
+    """Run func in a pool worker and return (result, seconds) so the parent can record the time"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
 # File Categories Mapping
 EXTENSION_MAP = {
     'documents': ['.pdf', '.docx', '.txt'],
@@ -78,6 +298,87 @@ EXT_TO_CATEGORY = {ext: cat for cat, exts in EXTENSION_MAP.items() for ext in ex
 # Directories & File Types to Exclude
 EXCLUDED_DIRS = {'Library', '.config', '.local', '.cache', 'Applications', 'node_modules', 'venv', '.npm', '.git'}
 EXCLUDED_FILE_TYPES = {'.log', '.tmp', '.bak'}
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp')
+
+# Perceptual hashing, "exact" matches imagehash.phash, "draft" decodes JPEGs at reduced size
+PHASH_MODE = os.getenv("phash_mode", "exact")
+PHASH_DRAFT_SIZE = int(os.getenv("phash_draft_size", 256))
+PHASH_SIZE = 8
+PHASH_HIGHFREQ_FACTOR = 4
+PHASH_BATCH = 32
+
+# Scan pipeline
+SCAN_ROOTS = [root for root in os.getenv("scan_root", "/home/shiv/programming/hackathon/smart-file-organiser/test").split(os.pathsep) if root]
+WALK_WORKERS = int(os.getenv("walk_workers", 8))
+HASH_WORKERS = int(os.getenv("hash_workers", os.cpu_count() or 4))
+SEND_WORKERS = int(os.getenv("send_workers", 4))
+WALK_QUEUE_SIZE = int(os.getenv("walk_queue_size", 1000))
+SEND_QUEUE_SIZE = int(os.getenv("send_queue_size", 1000))
+SCAN_PROGRESS_EVERY = 1000
+RECONCILE = os.getenv("reconcile", "1") == "1"
+MANIFEST_CHUNK = 1000
+
+# Watchdog event processing
+EVENT_QUIET_PERIOD = float(os.getenv("event_quiet_period", 1))
+EVENT_WORKERS = int(os.getenv("event_workers", 4))
+
+# Local hash cache
+HASH_CACHE_PATH = os.getenv("hash_cache", "hash_cache.db")
+HASH_CACHE_MAX_ENTRIES = int(os.getenv("hash_cache_max_entries", 2000000))
+HASH_CACHE_COMMIT_EVERY = 1000
+
+# Image captioning
+CAPTION_BACKEND = os.getenv("caption_backend", "gemini")
+CAPTION_WORKERS = int(os.getenv("caption_workers", 2))
+CAPTION_RATE = float(os.getenv("caption_rate", 0.25))  # model calls per second
+CAPTION_QUEUE_PATH = os.getenv("caption_queue", "captions.db")
+CAPTION_THUMBNAIL_SIZE = 768
+CAPTION_MAX_DISTANCE = 3  # phash bits two images may differ by and share a caption, the chunk index finds up to 3
+CAPTION_MAX_ATTEMPTS = 5
+CAPTION_BATCH = 16
+
+# Batched uploads
+UPLOAD_BATCH_SIZE = int(os.getenv("upload_batch_size", 500))
+UPLOAD_BATCH_INTERVAL = float(os.getenv("upload_batch_interval", 2))
+
+# Offline outbox for watchdog events
+OUTBOX_PATH = os.getenv("outbox", "outbox.db")
+OUTBOX_BATCH = UPLOAD_BATCH_SIZE  # events read per replay, so scan uploads still go as full batches
+OUTBOX_MAX_BACKOFF = float(os.getenv("outbox_max_backoff", 300))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("outbox_max_attempts", 3))  # server errors before an event is parked, network errors are retried forever
+OUTBOX_VACUUM_EVERY = 10000
+
+# Access times are collected per path and sent together
+ACCESS_FLUSH_INTERVAL = float(os.getenv("access_flush_interval", 30))
+ACCESS_MAX_PENDING = 10000
+
+# Staged dedupe: group by size, hash head and tail, full hash only on a partial match
+STAGED_DEDUPE = os.getenv("staged_dedupe", "0") == "1"
+PARTIAL_HASH_BYTES = int(os.getenv("partial_hash_kib", 64)) * 1024
+STAGED_BATCH_SIZE = 1000
+
+# Archive compression
+ARCHIVE_SUFFIX = ".archived"
+ARCHIVE_CODEC = os.getenv("archive_codec") or ("zstd" if zstandard else "gzip")
+ARCHIVE_LEVEL = int(os.getenv("archive_level", 3 if ARCHIVE_CODEC == "zstd" else 6))
+ARCHIVE_CHUNK = 1024 * 1024
+ARCHIVE_PROCESSES = int(os.getenv("archive_processes", 2))
+ARCHIVE_IO_RATE = float(os.getenv("archive_io_mib", 0)) * 1024 * 1024  # bytes/s across all processes, 0 = unlimited
+OWN_CHANGE_GRACE = 5  # seconds the watcher keeps ignoring a path after the agent finished changing it
+
+# Resource governor, the rates and thresholds can be changed at runtime in AGENT_SETTINGS_PATH
+AGENT_NICE = int(os.getenv("agent_nice", 10))
+AGENT_IO_PRIORITY = os.getenv("agent_io_priority", "low")  # idle, low or normal
+AGENT_SETTINGS_PATH = os.getenv("agent_settings", "agent_settings.json")
+GOVERNOR_SETTINGS = {
+    "scan_read_mib": float(os.getenv("scan_read_mib", 0)),  # 0 = unlimited
+    "scan_files_per_sec": float(os.getenv("scan_files_per_sec", 0)),  # 0 = unlimited
+    "governor": os.getenv("governor", "1") == "1",  # back off while other processes are busy
+    "governor_max_cpu": float(os.getenv("governor_max_cpu", 0.5)),
+    "governor_max_io": float(os.getenv("governor_max_io", 0.5)),
+}
+GOVERNOR_INTERVAL = 5
+GOVERNOR_MIN_FACTOR = 0.05
 
 
 
@@ -87,9 +388,8 @@ def generate_hash(file_path):
     """Generate a SHA-256 or perceptual hash based on file type"""
     try:
         # Check if the file is an image
-        if file_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tiff', '.webp')):
-            with Image.open(file_path) as img:
-                return str(imagehash.phash(img))  # Perceptual hash
+        if file_path.lower().endswith(IMAGE_EXTENSIONS):
+            return phash_batch([file_path])[0]  # Perceptual hash
         else:
             # For non-image files, use SHA-256
             hasher = hashlib.sha256()
@@ -101,6 +401,173 @@ def generate_hash(file_path):
         print(f"Error generating hash for {file_path}: {e}")
         return None
 
+def phash_pixels(file_path, mode=PHASH_MODE):
+    """Decode an image straight to the small grayscale square phash works on"""
+    img_size = PHASH_SIZE * PHASH_HIGHFREQ_FACTOR
+    with Image.open(file_path) as img:
+        if mode == "draft":
+            # JPEGs are decoded at 1/2, 1/4 or 1/8 scale, as long as they stay above PHASH_DRAFT_SIZE
+            img.draft("L", (PHASH_DRAFT_SIZE, PHASH_DRAFT_SIZE))
+        return numpy.asarray(img.convert("L").resize((img_size, img_size), Image.Resampling.LANCZOS))
+
+
+def phash_batch(file_paths, mode=PHASH_MODE):
+    """Perceptual hashes of several images, None for images that can't be read
+
+    Same algorithm as imagehash.phash, with the DCT and median computed for
+    the whole batch as one array operation. In "exact" mode the hashes are
+    bit for bit identical to imagehash.phash; "draft" mode trades a few
+    bits of agreement for a much cheaper JPEG decode.
+    """
+    results = [None] * len(file_paths)
+    pixels = []
+    decoded = []
+    for index, file_path in enumerate(file_paths):
+        try:
+            pixels.append(phash_pixels(file_path, mode))
+            decoded.append(index)
+        except Exception as e:
+            print(f"Error generating hash for {file_path}: {e}")
+    if not pixels:
+        return results
+
+    stack = numpy.stack(pixels)
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(stack, axis=1), axis=2)[:, :PHASH_SIZE, :PHASH_SIZE]
+    flat = dct.reshape(len(pixels), -1)
+    bits = flat > numpy.median(flat, axis=1)[:, None]
+    for index, packed in zip(decoded, numpy.packbits(bits, axis=1)):
+        results[index] = packed.tobytes().hex()
+    return results
+
+
+def partial_hash(file_path, size):
+    """SHA-256 of the first and last PARTIAL_HASH_BYTES, equal to the full hash for small files"""
+    try:
+        hasher = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            if size <= 2 * PARTIAL_HASH_BYTES:
+                while chunk := f.read(65536):
+                    hasher.update(chunk)
+            else:
+                # Mix in the size so files with the same head and tail but different lengths never collide
+                hasher.update(size.to_bytes(8, "little"))
+                hasher.update(f.read(PARTIAL_HASH_BYTES))
+                f.seek(-PARTIAL_HASH_BYTES, os.SEEK_END)
+                hasher.update(f.read(PARTIAL_HASH_BYTES))
+        return hasher.hexdigest()
+    except Exception as e:
+        print(f"Error generating partial hash for {file_path}: {e}")
+        return None
+
+
+class HashCache:
+    """On-disk cache of file hashes keyed by (st_dev, st_ino, st_size, st_mtime_ns)
+
+    A hit means the file has not changed since it was last hashed, so the
+    stored hash is returned without reading the file. Least recently used
+    entries are evicted once the cache grows past max_entries.
+    """
+
+    def __init__(self, path=HASH_CACHE_PATH, max_entries=HASH_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER NOT NULL,
+                ino INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (dev, ino)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)")
+        self.conn.commit()
+
+    def get(self, stat_info):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT hash FROM hashes WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                (stat_info.st_dev, stat_info.st_ino, stat_info.st_size, stat_info.st_mtime_ns)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE hashes SET last_used = ? WHERE dev = ? AND ino = ?",
+                              (time.time(), stat_info.st_dev, stat_info.st_ino))
+            self._written()
+            return row[0]
+
+    def put(self, stat_info, file_hash):
+        with self.lock:
+            # One row per inode, a changed file replaces its stale entry
+            self.conn.execute(
+                "INSERT OR REPLACE INTO hashes (dev, ino, size, mtime_ns, hash, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (stat_info.st_dev, stat_info.st_ino, stat_info.st_size, stat_info.st_mtime_ns, file_hash, time.time()))
+            self._written()
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= HASH_CACHE_COMMIT_EVERY:
+            self._evict()
+            self.conn.commit()
+            self.pending = 0
+
+    def _evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        if count > self.max_entries:
+            self.conn.execute(
+                "DELETE FROM hashes WHERE rowid IN (SELECT rowid FROM hashes ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,))
+
+    def flush(self):
+        with self.lock:
+            self._evict()
+            self.conn.commit()
+            self.pending = 0
+
+
+hash_cache = None
+hash_cache_lock = threading.Lock()
+
+
+def get_hash_cache():
+    # Created on first use, so pool workers that re-import this module don't open it
+    global hash_cache
+    with hash_cache_lock:
+        if hash_cache is None:
+            hash_cache = HashCache()
+        return hash_cache
+
+
+def cached_hash(file_path, stat_info):
+    """Return the cached hash for an unchanged file, hashing it otherwise"""
+    file_hash = get_hash_cache().get(stat_info)
+    if file_hash:
+        return file_hash
+    get_governor().acquire(stat_info.st_size)
+    file_hash = generate_hash(file_path)
+    if file_hash:
+        get_hash_cache().put(stat_info, file_hash)
+    return file_hash
+
+
+def content_hash(file_path, stat_info):
+    """SHA-256 of the file's bytes, images included (their cached hash is a phash)"""
+    if not file_path.lower().endswith(IMAGE_EXTENSIONS):
+        file_hash = cached_hash(file_path, stat_info)
+        if file_hash:
+            return file_hash
+    get_governor().acquire(stat_info.st_size)
+    hasher = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
 TRASH_DIRS = [
     os.path.expanduser("~/.local/share/Trash/files"),  # Linux
     os.path.expanduser("~/.Trash"),  # macOS
@@ -112,259 +579,1604 @@ def categorize_file(filename):
     return EXT_TO_CATEGORY.get(os.path.splitext(filename)[1].lower(), 'others')
 
 
+class TokenBucket:
+    """Allows `rate` operations per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # Requests bigger than the bucket go through once it is full
+                if self.tokens >= min(amount, self.capacity):
+                    self.tokens -= amount
+                    return
+                wait = (min(amount, self.capacity) - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def set_rate(self, rate, capacity=None):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+            self.capacity = capacity or max(rate, 1)
+            self.tokens = min(self.tokens, self.capacity)
+
+
+def apply_priority(nice=AGENT_NICE, io_priority=AGENT_IO_PRIORITY):
+    """Lower the agent's CPU and I/O priority, inherited by the threads and pool processes started after it"""
+    if nice and hasattr(os, "nice"):
+        try:
+            os.nice(nice)
+        except OSError as e:
+            logging.error(f"Couldn't set niceness {nice}: {e}")
+    if io_priority == "normal":
+        return
+    if not shutil.which("ionice"):
+        logging.info("ionice not found, I/O priority left at normal")
+        return
+    # Best effort class, lowest level, or the idle class which only gets the disk when nothing else wants it
+    args = ["-c", "3"] if io_priority == "idle" else ["-c", "2", "-n", "7"]
+    result = subprocess.run(["ionice", *args, "-p", str(os.getpid())], capture_output=True, text=True)
+    if result.returncode != 0:
+        logging.error(f"Couldn't set I/O priority {io_priority}: {result.stderr.strip()}")
+
+
+class ForegroundSampler:
+    """Share of CPU time and disk busy time used by processes other than the agent, from /proc
+
+    The agent's own CPU ticks (its pool processes included) are taken off
+    the machine's busy ticks. Disk busy time can't be split by process, so
+    it is scaled by the share of bytes transferred that weren't the agent's.
+    """
+
+    def __init__(self):
+        self.disks = [name for name in os.listdir("/sys/block") if not name.startswith(("loop", "ram", "zram"))]
+        self.own = {}  # pid -> [cpu ticks, bytes read and written]
+        self.last = self._read()
+
+    @staticmethod
+    def _read_machine():
+        with open("/proc/stat") as f:
+            ticks = [int(value) for value in f.readline().split()[1:9]]
+        disks = {}
+        with open("/proc/diskstats") as f:
+            for line in f:
+                fields = line.split()
+                # sectors read, sectors written, milliseconds spent doing I/O
+                disks[fields[2]] = (int(fields[5]), int(fields[9]), int(fields[12]))
+        return sum(ticks), ticks[3] + ticks[4], disks
+
+    def _read_own(self):
+        """Ticks and bytes the agent's processes used since the last call"""
+        cpu = io = 0
+        for pid in [os.getpid()] + [child.pid for child in multiprocessing.active_children()]:
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    # Fields after the command name, which may contain spaces, utime and stime are 14 and 15
+                    fields = f.read().rsplit(")", 1)[1].split()
+                ticks = int(fields[11]) + int(fields[12])
+                with open(f"/proc/{pid}/io") as f:
+                    counters = dict(line.split(": ") for line in f.read().splitlines())
+                transferred = int(counters["read_bytes"]) + int(counters["write_bytes"])
+            except (OSError, KeyError, IndexError, ValueError):
+                continue
+            last = self.own.get(pid, [0, 0])
+            cpu += ticks - last[0]
+            io += transferred - last[1]
+            self.own[pid] = [ticks, transferred]
+        return cpu, io
+
+    def _read(self):
+        total, idle, disks = self._read_machine()
+        own_cpu, own_io = self._read_own()
+        return time.monotonic(), total, idle, disks, own_cpu, own_io
+
+    def sample(self):
+        """(foreground CPU share, foreground disk busy share) since the last sample"""
+        now, total, idle, disks, own_cpu, own_io = current = self._read()
+        last_now, last_total, last_idle, last_disks = self.last[:4]
+        self.last = current
+
+        ticks = total - last_total
+        busy = ticks - (idle - last_idle)
+        cpu = max(0, busy - own_cpu) / ticks if ticks > 0 else 0.0
+
+        elapsed_ms = (now - last_now) * 1000
+        io_busy, transferred = 0.0, 0
+        for name in self.disks:
+            if name in disks and name in last_disks:
+                read, written, io_ms = (a - b for a, b in zip(disks[name], last_disks[name]))
+                io_busy = max(io_busy, io_ms / elapsed_ms if elapsed_ms > 0 else 0.0)
+                transferred += (read + written) * 512
+        own_share = min(1.0, own_io / transferred) if transferred > 0 else 0.0
+        return cpu, min(1.0, io_busy) * (1 - own_share)
+
+
+class ResourceGovernor:
+    """Token-bucket limits on the bytes read and files hashed by background work
+
+    The startup scan, hashing in the watch handlers and archive tasks all
+    call acquire() before reading a file. scan_read_mib and
+    scan_files_per_sec set fixed limits. With the governor on, those
+    limits are halved while other processes use more than
+    governor_max_cpu of the CPU or governor_max_io of the disk's time, and
+    raised again by a quarter each interval while the machine is idle.
+    An unlimited rate is held to a share of the highest rate measured
+    while it was free. Settings are re-read from settings_path whenever
+    the file changes.
+    """
+
+    def __init__(self, settings=GOVERNOR_SETTINGS, settings_path=AGENT_SETTINGS_PATH, interval=GOVERNOR_INTERVAL):
+        self.settings = dict(settings)
+        self.settings_path = settings_path
+        self.settings_mtime = None
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.factor = 1.0
+        self.used = {"bytes": 0, "files": 0}     # since the last interval
+        self.peak = {"bytes": 0.0, "files": 0.0}  # highest rate measured while unlimited
+        self.buckets = {"bytes": None, "files": None}
+        try:
+            self.sampler = ForegroundSampler()
+        except OSError:
+            self.sampler = None  # no /proc, limits stay fixed
+        self._apply()
+        threading.Thread(target=self._adjust_periodically, daemon=True).start()
+
+    def acquire(self, nbytes, files=1):
+        with self.lock:
+            self.used["bytes"] += nbytes
+            self.used["files"] += files
+            buckets = dict(self.buckets)
+        if files and buckets["files"]:
+            buckets["files"].acquire(files)
+        if nbytes and buckets["bytes"]:
+            buckets["bytes"].acquire(nbytes)
+
+    def update(self, **settings):
+        unknown = settings.keys() - self.settings.keys()
+        if unknown:
+            raise ValueError(f"Unknown governor settings: {', '.join(sorted(unknown))}")
+        with self.lock:
+            self.settings.update(settings)
+            if not self.settings["governor"]:
+                self.factor = 1.0
+            self._apply()
+        logging.info(f"Governor settings: {json.dumps(self.settings)}")
+
+    def limits(self):
+        with self.lock:
+            return {resource: bucket.rate if bucket else 0 for resource, bucket in self.buckets.items()}
+
+    def _apply(self):
+        """Point the buckets at the current limits, with self.lock held"""
+        fixed = {"bytes": self.settings["scan_read_mib"] * 1024 * 1024, "files": self.settings["scan_files_per_sec"]}
+        for resource, base in fixed.items():
+            if not base and self.factor < 1:
+                base = self.peak[resource]
+            rate = base * self.factor
+            bucket = self.buckets[resource]
+            if not rate:
+                self.buckets[resource] = None
+            elif bucket:
+                bucket.set_rate(rate)
+            else:
+                self.buckets[resource] = TokenBucket(rate)
+            GOVERNOR_LIMIT.set(rate, resource=resource)
+        GOVERNOR_FACTOR.set(self.factor)
+
+    def _reload_settings(self):
+        try:
+            mtime = os.stat(self.settings_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self.settings_mtime:
+            return
+        self.settings_mtime = mtime
+        try:
+            with open(self.settings_path) as f:
+                settings = json.load(f)
+            self.update(**{key: value for key, value in settings.items() if key in self.settings})
+        except (OSError, ValueError, TypeError) as e:
+            logging.error(f"Couldn't read {self.settings_path}: {e}")
+
+    def _adjust_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            self._reload_settings()
+            self._adjust()
+
+    def _adjust(self):
+        cpu, io = self.sampler.sample() if self.sampler else (0.0, 0.0)
+        GOVERNOR_FOREGROUND.set(cpu, resource="cpu")
+        GOVERNOR_FOREGROUND.set(io, resource="io")
+        with self.lock:
+            for resource, used in self.used.items():
+                if not self.buckets[resource]:
+                    self.peak[resource] = max(self.peak[resource], used / self.interval)
+            self.used = {"bytes": 0, "files": 0}
+            if not self.settings["governor"] or not self.sampler:
+                return
+            max_cpu, max_io = self.settings["governor_max_cpu"], self.settings["governor_max_io"]
+            if cpu > max_cpu or io > max_io:
+                factor = max(GOVERNOR_MIN_FACTOR, self.factor / 2)
+            elif cpu < max_cpu / 2 and io < max_io / 2:
+                factor = min(1.0, self.factor * 1.25)
+            else:
+                return
+            if factor != self.factor:
+                logging.info(f"Governor: foreground cpu {cpu:.0%}, io {io:.0%}, background at {factor:.0%}")
+                self.factor = factor
+                self._apply()
+
+
+governor = None
+governor_lock = threading.Lock()
+
+
+def get_governor():
+    # Created on first use, so importing this module (or a pool worker re-importing it) starts no sampler thread
+    global governor
+    with governor_lock:
+        if governor is None:
+            governor = ResourceGovernor()
+        return governor
+
+
+class GeminiCaptioner:
+    def __init__(self):
+        self.client = genai.Client(api_key=geminkey)
+
+    def caption(self, image):
+        response = self.client.models.generate_content(model="gemini-2.0-flash",contents=["What is this image?", image])
+        return response.text
+
+
+class StubCaptioner:
+    """Offline stand-in for the model, used in tests and benchmarks"""
+
+    def caption(self, image):
+        return f"an image of {image.width}x{image.height} pixels"
+
+
+CAPTION_BACKENDS = {
+    "gemini": GeminiCaptioner,
+    "stub": StubCaptioner,
+}
+
+
+def split_phash(phash):
+    """Split a 64 bit phash in four 16 bit chunks, two hashes within 3 bits share at least one"""
+    value = int(phash, 16)
+    return value, [(value >> shift) & 0xFFFF for shift in (48, 32, 16, 0)]
+
+
+class CaptionQueue:
+    """Persistent queue of images waiting for a caption
+
+    Images are queued by the upload path and captioned by worker threads,
+    at most `rate` model calls per second. Captions are cached by phash, so
+    an image whose phash is within CAPTION_MAX_DISTANCE bits of one that
+    was already captioned reuses that caption instead of calling the model.
+    """
+
+    def __init__(self, backend=None, path=CAPTION_QUEUE_PATH, workers=CAPTION_WORKERS, rate=CAPTION_RATE):
+        self.backend = backend or CAPTION_BACKENDS[CAPTION_BACKEND]()
+        self.bucket = TokenBucket(rate)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY,
+                file_data TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                not_before REAL NOT NULL DEFAULT 0,
+                claimed INTEGER NOT NULL DEFAULT 0
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS captions (
+                phash INTEGER PRIMARY KEY,
+                c0 INTEGER, c1 INTEGER, c2 INTEGER, c3 INTEGER,
+                caption TEXT NOT NULL
+            )""")
+        for i in range(4):
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS captions_c{i} ON captions (c{i})")
+        # Rows claimed by a previous run that died are picked up again
+        self.db.execute("UPDATE queue SET claimed = 0")
+        self.db.commit()
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def put(self, file_data):
+        with self.lock:
+            self.db.execute("INSERT INTO queue (file_data) VALUES (?)", (json.dumps(file_data),))
+            self.db.commit()
+            self.ready.notify()
+
+    def depth(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def cached_caption(self, phash):
+        try:
+            value, chunks = split_phash(phash)
+        except ValueError:
+            return None
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT phash, caption FROM captions WHERE phash = ? OR c0 = ? OR c1 = ? OR c2 = ? OR c3 = ?",
+                (value - (1 << 63), *chunks)).fetchall()
+        best = None
+        for stored, caption in rows:
+            distance = ((stored + (1 << 63)) ^ value).bit_count()
+            if distance <= CAPTION_MAX_DISTANCE and (best is None or distance < best[0]):
+                best = (distance, caption)
+        return best[1] if best else None
+
+    def store_caption(self, phash, caption):
+        try:
+            value, chunks = split_phash(phash)
+        except ValueError:
+            return
+        with self.lock:
+            # SQLite integers are signed, shift the unsigned 64 bit phash into range
+            self.db.execute("INSERT OR REPLACE INTO captions (phash, c0, c1, c2, c3, caption) VALUES (?, ?, ?, ?, ?, ?)",
+                            (value - (1 << 63), *chunks, caption))
+            self.db.commit()
+
+    def _claim(self):
+        with self.lock:
+            while True:
+                rows = self.db.execute(
+                    "SELECT id, file_data, attempts FROM queue WHERE claimed = 0 AND not_before <= ? ORDER BY id LIMIT ?",
+                    (time.time(), CAPTION_BATCH)).fetchall()
+                if rows:
+                    self.db.executemany("UPDATE queue SET claimed = 1 WHERE id = ?", [(row[0],) for row in rows])
+                    self.db.commit()
+                    return rows
+                self.ready.wait(5)
+
+    def _work(self):
+        while True:
+            for row_id, file_data, attempts in self._claim():
+                file_data = json.loads(file_data)
+                try:
+                    self._caption(file_data)
+                    with self.lock:
+                        self.db.execute("DELETE FROM queue WHERE id = ?", (row_id,))
+                        self.db.commit()
+                except Exception as e:
+                    logging.error(f"Captioning {file_data['path']} failed (attempt {attempts + 1}): {e}")
+                    with self.lock:
+                        if attempts + 1 >= CAPTION_MAX_ATTEMPTS or not os.path.exists(file_data['path']):
+                            self.db.execute("DELETE FROM queue WHERE id = ?", (row_id,))
+                        else:
+                            self.db.execute("UPDATE queue SET claimed = 0, attempts = ?, not_before = ? WHERE id = ?",
+                                            (attempts + 1, time.time() + 2 ** (attempts + 4), row_id))
+                        self.db.commit()
+
+    def _caption(self, file_data):
+        caption = self.cached_caption(file_data["hash"])
+        if caption is None:
+            with PIL.Image.open(file_data['path']) as image:
+                # Decode at reduced size where the format allows it, the model only needs a thumbnail
+                image.draft("RGB", (CAPTION_THUMBNAIL_SIZE, CAPTION_THUMBNAIL_SIZE))
+                image = image.convert("RGB")
+                image.thumbnail((CAPTION_THUMBNAIL_SIZE, CAPTION_THUMBNAIL_SIZE))
+            self.bucket.acquire()
+            with CAPTION_SECONDS.time(backend=type(self.backend).__name__):
+                caption = self.backend.caption(image).lower()
+            self.store_caption(file_data["hash"], caption)
+        else:
+            logging.info(f"Reused cached caption for {file_data['path']}")
+
+        api_post("/image/upload",json={
+             "device_id": file_data["device_id"],
+            "username": file_data["username"],
+            "name": file_data["name"],
+            "path": file_data["path"],
+            "response": caption
+        },timeout=5)
+
+
+caption_queue = None
+caption_queue_lock = threading.Lock()
+
+
+def get_caption_queue():
+    global caption_queue
+    with caption_queue_lock:
+        if caption_queue is None:
+            caption_queue = CaptionQueue()
+        return caption_queue
+
+
+def caption_image(file_data):
+    get_caption_queue().put(file_data)
+
+
+def remove_duplicate(file_data, clean):
+    logging.info(f" Already exists: {file_data['path']}")
+    if clean:
+        try:
+            os.remove(file_data['path'])
+        except:
+            print("failed")
+
+
 def send_to_api(file_data):
+    get_outbox().append("send", file_data)
+
+
+class UploadBatcher:
+    """Buffers scanned file records and writes them to the outbox
+
+    A batch is written in one transaction once it holds batch_size records
+    or when it has been waiting for longer than interval seconds, whichever
+    comes first. The outbox sends it as one /upload/batch request and keeps
+    it until the backend has answered, across outages and restarts.
+    """
+
+    def __init__(self, batch_size=UPLOAD_BATCH_SIZE, interval=UPLOAD_BATCH_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def add(self, file_data):
+        with self.lock:
+            self.buffer.append(file_data)
+            if len(self.buffer) < self.batch_size:
+                return
+            batch = self._take()
+        self._send(batch)
+
+    def flush(self):
+        with self.lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def _take(self):
+        batch, self.buffer = self.buffer, []
+        self.last_flush = time.monotonic()
+        return batch
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            if time.monotonic() - self.last_flush >= self.interval:
+                self.flush()
+
+    def _send(self, batch):
+        get_outbox().append_many("send", batch)
+
+
+def handle_upload_result(file_data, result):
     try:
-        response = requests.post(API_URL+"/upload", json=file_data, timeout=5)
-        data = response.json()
-        if response.status_code == 201:
+        if result["status"] in ("created", "updated"):
             logging.info(f"Sent: {file_data['path']}")
             if file_data['category'] == "images":
-                image = PIL.Image.open(file_data['path'])
-                client = genai.Client(api_key=geminkey)
-                response = client.models.generate_content(model="gemini-2.0-flash",contents=["What is this image?", image])
-                requests.post(API_URL+"/image/upload",json={
-                     "device_id": file_data["device_id"],
-                    "username": file_data["username"],
-                    "name": file_data["name"],
-                    "path": file_data["path"],
-                    "response": response.text.lower()
-                },timeout=5)
-                print(response.text + "/n/n")
-
-
-        elif response.status_code == 409:
-            logging.info(f" Already exists: {file_data['path']}")
-            if data["clean"]:
-                try:
-                    os.remove(file_data['path'])
-                except:
-                    print("failed")
+                caption_image(file_data)
+        elif result["status"] == "duplicate":
+            remove_duplicate(file_data, result["clean"])
+        elif result["status"] == "unchanged":
+            logging.info(f"Unchanged: {file_data['path']}")
         else:
-            logging.error(f"Failed to send {file_data['path']}: {response.text}")
-    except requests.exceptions.RequestException as e:
-        logging.error(f" Network error sending {file_data['path']}: {e}")
+            logging.error(f"Failed to send {file_data['path']}: {result.get('error')}")
+    except Exception as e:
+        logging.error(f"Error handling result for {file_data['path']}: {e}")
+
+
+upload_batcher = None
+upload_batcher_lock = threading.Lock()
+
+
+def get_upload_batcher():
+    global upload_batcher
+    with upload_batcher_lock:
+        if upload_batcher is None:
+            upload_batcher = UploadBatcher()
+        return upload_batcher
+
+
+class Outbox:
+    """Durable journal of events for the backend, replayed in order
+
+    Uploads, deletes, moves and access updates are written here before
+    they are sent, so events raised while the backend is unreachable
+    survive outages and restarts. One flusher thread sends them oldest
+    first, with each run of consecutive uploads sent as one /upload/batch
+    request. It backs off exponentially while the backend can't be
+    reached, and deletes events once the backend has answered them. Events
+    the backend keeps failing with a server error are moved to dead_events,
+    so they don't hold up the ones behind them.
+    """
+
+    ENDPOINTS = {"delete": "/delete", "move": "/mov", "access": "/acc", "access_batch": "/acc/batch",
+                 "delete_dir": "/delete/dir", "move_dir": "/mov/dir", "archive_report": "/archive/report"}
+
+    def __init__(self, path=OUTBOX_PATH, batch_size=OUTBOX_BATCH):
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.drained = threading.Condition(self.lock)
+        self.acked = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS dead_events (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                error TEXT,
+                failed_at REAL NOT NULL
+            )""")
+        self.db.commit()
+        threading.Thread(target=self._flush, daemon=True).start()
+
+    def append(self, kind, payload):
+        self.append_many(kind, [payload])
+
+    def append_many(self, kind, payloads):
+        with self.lock:
+            self.db.executemany("INSERT INTO events (kind, payload) VALUES (?, ?)",
+                                [(kind, json.dumps(payload)) for payload in payloads])
+            self.db.commit()
+            self.ready.notify()
+
+    def wait_drained(self, timeout=None):
+        """Block until the backend has answered every event, returns False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.db.execute("SELECT 1 FROM events LIMIT 1").fetchone():
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.drained.wait(remaining)
+            return True
+
+    def depth(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def _pending(self):
+        with self.lock:
+            while True:
+                rows = self.db.execute("SELECT id, kind, payload, attempts FROM events ORDER BY id LIMIT ?",
+                                       (self.batch_size,)).fetchall()
+                if rows:
+                    return rows
+                self.ready.wait(5)
+
+    def _flush(self):
+        backoff = 1
+        while True:
+            rows = self._pending()
+            try:
+                replayed = self._replay(rows)
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Network error replaying outbox, {self.depth()} events kept: {e}")
+                replayed = False
+            if replayed:
+                backoff = 1
+                continue
+            time.sleep(backoff)
+            backoff = min(backoff * 2, OUTBOX_MAX_BACKOFF)
+
+    def _replay(self, rows):
+        """Send rows in order, returns False once the backend fails to answer one"""
+        groups = []
+        for row in rows:
+            if row[1] == "send" and groups and groups[-1][0][1] == "send":
+                groups[-1].append(row)
+            else:
+                groups.append([row])
+
+        for group in groups:
+            kind = group[0][1]
+            payloads = [json.loads(row[2]) for row in group]
+            if kind == "send":
+                response = api_post("/upload/batch", json={"files": payloads}, timeout=60)
+            else:
+                response = api_post(self.ENDPOINTS[kind], json=payloads[0], timeout=5)
+
+            if response.status_code >= 500:
+                if not self._retry(group, response):
+                    return False
+                continue
+            if kind == "send" and response.status_code == 200:
+                for file_data, result in zip(payloads, response.json()["results"]):
+                    handle_upload_result(file_data, result)
+            elif kind == "access_batch" and response.status_code == 200:
+                logging.info(f"Access times updated: {response.json()['updated']} of {len(payloads[0]['updates'])}")
+            elif response.status_code == 200:
+                logging.info(f"{kind}: {event_subject(payloads[0])} {response.json().get('message', '')}")
+            elif response.status_code == 409:
+                logging.info(f" {kind} failed, {response.json().get('error')}: {event_subject(payloads[0])}")
+            else:
+                logging.error(f"Failed to {kind} {len(payloads)} events: {response.text}")
+            self._ack(group)
+        return True
+
+    def _retry(self, group, response):
+        """Count a server error against the group, parking it after OUTBOX_MAX_ATTEMPTS, returns True if parked"""
+        attempts = max(row[3] for row in group) + 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            # A failure that repeats is most likely the event itself, keep it for inspection and move on
+            logging.error(f"Moving {len(group)} {group[0][1]} events to dead_events after {attempts} attempts: "
+                          f"{response.text}")
+            with self.lock:
+                self.db.executemany(
+                    "INSERT INTO dead_events (id, kind, payload, attempts, error, failed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(row[0], row[1], row[2], attempts, response.text, time.time()) for row in group])
+            self._ack(group)
+            return True
+        with self.lock:
+            self.db.executemany("UPDATE events SET attempts = ? WHERE id = ?", [(attempts, row[0]) for row in group])
+            self.db.commit()
+        return False
+
+    def _ack(self, group):
+        with self.lock:
+            self.db.executemany("DELETE FROM events WHERE id = ?", [(row[0],) for row in group])
+            self.db.commit()
+            self.drained.notify_all()
+            self.acked += len(group)
+            # Give the space of acknowledged events back once the journal has drained
+            if self.acked >= OUTBOX_VACUUM_EVERY and not self.db.execute("SELECT 1 FROM events LIMIT 1").fetchone():
+                self.db.execute("VACUUM")
+                self.acked = 0
+
+
+def event_subject(payload):
+    return payload.get("path") or payload.get("old") or payload.get("name")
+
+
+outbox = None
+outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    global outbox
+    with outbox_lock:
+        if outbox is None:
+            outbox = Outbox()
+        return outbox
+
+
+def del_to_api(file_path):
+    file_data = {
+                "device_id": DEVICE_ID,
+                "username": USERNAME,
+                "name": os.path.basename(file_path),
+                "path": file_path
+            }
+    get_outbox().append("delete", file_data)
+
+
+def del_dir_to_api(dir_path):
+    # Every file below the directory goes in one request
+    get_outbox().append("delete_dir", {
+        "device_id": DEVICE_ID,
+        "username": USERNAME,
+        "path": os.path.join(dir_path, "")
+    })
+
+
+def mov_dir_to_api(old, new):
+    get_outbox().append("move_dir", {
+        "device_id": DEVICE_ID,
+        "username": USERNAME,
+        "old": os.path.join(old, ""),
+        "new": os.path.join(new, "")
+    })
+
+
+def mov_to_api(filename,old,new):
+    file_data = {
+                "device_id": DEVICE_ID,
+                "username": USERNAME,
+                "name": filename,
+                "old":old,
+                "new":new
+            }
+    get_outbox().append("move", file_data)
+
+class AccessCoalescer:
+    """Keeps the latest access time per path and sends them together
+
+    Every interval seconds (or once max_pending paths are waiting) the
+    pending times go to the outbox as one /acc/batch event, so a file read
+    over and over costs a dict update instead of a request per read.
+    """
+
+    def __init__(self, interval=ACCESS_FLUSH_INTERVAL, max_pending=ACCESS_MAX_PENDING):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = {}  # path -> ISO access time
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+
+    def record(self, path, when):
+        date = when.isoformat()
+        with self.lock:
+            if date > self.pending.get(path, ""):
+                self.pending[path] = date
+            full = len(self.pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    def moved(self, old, new, directory=False):
+        with self.lock:
+            if not directory:
+                if old in self.pending:
+                    self.pending[new] = self.pending.pop(old)
+                return
+            old, new = os.path.join(old, ""), os.path.join(new, "")
+            for path in [path for path in self.pending if path.startswith(old)]:
+                self.pending[new + path[len(old):]] = self.pending.pop(path)
+
+    def forget(self, path, directory=False):
+        with self.lock:
+            if not directory:
+                self.pending.pop(path, None)
+                return
+            prefix = os.path.join(path, "")
+            for path in [path for path in self.pending if path.startswith(prefix)]:
+                del self.pending[path]
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if pending:
+            get_outbox().append("access_batch", {
+                "device_id": DEVICE_ID,
+                "username": USERNAME,
+                "updates": [{"path": path, "date": date} for path, date in pending.items()]
+            })
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+access_coalescer = None
+access_coalescer_lock = threading.Lock()
+
+
+def get_access_coalescer():
+    global access_coalescer
+    with access_coalescer_lock:
+        if access_coalescer is None:
+            access_coalescer = AccessCoalescer()
+        return access_coalescer
+
+
+FileRecord = namedtuple("FileRecord", ["path", "name", "stat"])
+
+
+def should_scan_file(name):
+    if name.startswith('.') or name.startswith('_'):
+        return False
+    return os.path.splitext(name)[1].lower() not in EXCLUDED_FILE_TYPES
 
-def del_to_api(filename):
+
+def is_excluded_dir(name):
+    return name.startswith('.') or name in EXCLUDED_DIRS
+
+
+def should_scan_path(path, directory=False):
+    """The walk's filters applied to a whole path, so the watcher stores exactly what a scan would find"""
+    parts = [part for part in os.path.normpath(path).split(os.sep) if part]
+    if not directory:
+        if not parts or not should_scan_file(parts.pop()):
+            return False
+    return not any(is_excluded_dir(part) for part in parts)
+
+
+def walk_home_directory(roots, workers=WALK_WORKERS, errors=None):
+    """Yield a FileRecord for every file under roots
+
+    Directories are read with os.scandir on a pool of threads sharing one
+    queue of directories, so several roots and large subtrees are walked in
+    parallel. Hidden and excluded directories are pruned before anything
+    below them is read, and each file is stat'ed once through its DirEntry.
+    Paths that couldn't be read are appended to errors, directories with a
+    trailing separator.
+    """
+    if isinstance(roots, str):
+        roots = [roots]
+    dirs = queue.Queue()
+    records = queue.Queue(maxsize=WALK_QUEUE_SIZE)
+    lock = threading.Lock()
+    outstanding = [len(roots)]
+
+    def walk():
+        while True:
+            directory = dirs.get()
+            if directory is None:
+                return
+            started = time.perf_counter()
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        name = entry.name
+                        try:
+                            if entry.is_dir():
+                                # Symlinked directories are not followed, same as os.walk
+                                if entry.is_symlink() or is_excluded_dir(name):
+                                    continue
+                                with lock:
+                                    outstanding[0] += 1
+                                dirs.put(entry.path)
+                            elif should_scan_file(name):
+                                stat_started = time.perf_counter()
+                                stat_info = entry.stat()
+                                STAT_SECONDS.observe(time.perf_counter() - stat_started)
+                                records.put(FileRecord(entry.path, name, stat_info))
+                        except OSError as e:
+                            logging.error(f"Error processing {entry.path}: {e}")
+                            if errors is not None:
+                                errors.append(entry.path)
+            except OSError as e:
+                logging.error(f"Error reading {directory}: {e}")
+                if errors is not None:
+                    errors.append(os.path.join(directory, ""))
+            finally:
+                WALK_DIR_SECONDS.observe(time.perf_counter() - started)
+                with lock:
+                    outstanding[0] -= 1
+                    finished = outstanding[0] == 0
+                if finished:
+                    for _ in range(workers):
+                        dirs.put(None)
+                    records.put(None)
+
+    if not roots:
+        return
+    for root in roots:
+        dirs.put(root)
+    for _ in range(workers):
+        threading.Thread(target=walk, daemon=True).start()
+
+    while True:
+        record = records.get()
+        if record is None:
+            return
+        yield record
+
+
+def build_file_data(file_path, file, stat_info, file_hash, partial=None):
+    file_data = {
+        "device_id": DEVICE_ID,
+        "username": USERNAME,
+        "name": file,
+        "path": file_path,
+        "size": stat_info.st_size,
+        "hash": file_hash,
+        "category": categorize_file(file),
+        "last_access": datetime.datetime.fromtimestamp(stat_info.st_atime).isoformat(),
+        "mtime": stat_info.st_mtime
+    }
+    if partial:
+        file_data["partial_hash"] = partial
+    return file_data
+
+
+def fetch_known_sizes(sizes):
+    """Ask the server which of these sizes it already stores, None if it can't be reached"""
     try:
-        file_data = {
-                    "device_id": DEVICE_ID,
-                    "username": USERNAME,
-                    "name": filename
-                }
-        response = requests.post(API_URL+"/delete", json=file_data, timeout=5)
-        if response.status_code == 201:
-            logging.info(f"delete: {file_data['name']}")
-        elif response.status_code == 409:
-            logging.info(f" doesnt exists: {file_data['name']}")
-        else:
-            logging.error(f"Failed to del {file_data['name']}: {response.text}")
+        response = api_post("/files/sizes", json={"sizes": list(sizes)}, timeout=30)
+        if response.status_code != 200:
+            logging.error(f"Failed to fetch known sizes: {response.text}")
+            return None
+        return {int(size): entries for size, entries in response.json()["sizes"].items()}
     except requests.exceptions.RequestException as e:
-        logging.error(f"Network error sending {file_data['name']}: {e}")
+        logging.error(f"Network error fetching known sizes: {e}")
+        return None
 
 
-def mov_to_api(filename,old,new):
+def request_rehash(files):
+    """Ask the devices owning these partial-only rows to send their full hashes"""
     try:
-        file_data = {
-                    "device_id": DEVICE_ID,
-                    "username": USERNAME,
-                    "name": filename,
-                    "old":old,
-                    "new":new
-                }
-        response = requests.post(API_URL+"/mov", json=file_data, timeout=5)
-        if response.status_code == 201:
-            logging.info(f"move: {file_data['name']}")
-        elif response.status_code == 409:
-            logging.info(f" doesnt exists: {file_data['name']}")
+        response = api_post("/files/rehash/request", json={"files": files}, timeout=30)
+        if response.status_code != 200:
+            logging.error(f"Failed to request rehash of {len(files)} files: {response.text}")
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Network error requesting rehash of {len(files)} files: {e}")
+
+
+def staged_hashes(pool, items, seen, stats):
+    """Hash a batch of non-image files reading as little of each file as possible
+
+    Every file gets a partial hash. The full hash is only computed when
+    another file of the same size, on the server or earlier in this scan,
+    has the same partial hash or a partial hash that isn't known. Files on
+    this device that were stored with only a partial hash are fully hashed
+    as well and updated through /files/rehash so the server can compare them.
+    A match stored with only a partial hash by another device can't be
+    checked here: its device is asked to rehash it, and the file is held
+    back as an unverified duplicate until the next scan.
+    """
+    sizes = {stat_info.st_size for _, _, stat_info in items}
+    known = fetch_known_sizes(sizes)
+    if known is None:
+        # Can't tell what is unique, fall back to full hashes for everything
+        known = {size: [{"partial_hash": None, "hash": None, "device_id": None, "path": None}] for size in sizes}
+    for size in sizes:
+        known.setdefault(size, []).extend(seen.get(size, []))
+
+    with HASH_SECONDS.time(kind="partial_batch"):
+        partials = list(pool.map(partial_hash, [p for p, _, _ in items], [st.st_size for _, _, st in items], chunksize=16))
+    for _, _, stat_info in items:
+        stats.read(min(stat_info.st_size, 2 * PARTIAL_HASH_BYTES))
+
+    local_counts = {}
+    for (_, _, stat_info), partial in zip(items, partials):
+        local_counts[(stat_info.st_size, partial)] = local_counts.get((stat_info.st_size, partial), 0) + 1
+
+    batch_paths = {p for p, _, _ in items}
+    needs_full = []
+    upgrades = {}
+    unverified = {}  # item index -> partial-only match on another device
+    for index, ((file_path, _, stat_info), partial) in enumerate(zip(items, partials)):
+        size = stat_info.st_size
+        if not partial or size <= 2 * PARTIAL_HASH_BYTES:
+            continue
+        # The file's own stored row is no match, or every rescan would read every large file in full
+        matches = [e for e in known[size] if (e["partial_hash"] is None or e["partial_hash"] == partial)
+                   and not (e["device_id"] == DEVICE_ID and e["path"] == file_path)]
+        if not matches and local_counts[(size, partial)] == 1:
+            continue
+        needs_full.append(index)
+        for e in matches:
+            if e["partial_hash"] != partial or e["hash"] != partial:
+                continue
+            if e["device_id"] != DEVICE_ID:
+                unverified[index] = e
+            elif e["path"] not in batch_paths and os.path.exists(e["path"]):
+                upgrades[e["path"]] = size
+
+    full_paths = [items[i][0] for i in needs_full] + list(upgrades)
+    get_governor().acquire(sum(items[i][2].st_size for i in needs_full) + sum(upgrades.values()), files=len(upgrades))
+    with HASH_SECONDS.time(kind="full_batch"):
+        full_hashes = dict(zip(full_paths, pool.map(generate_hash, full_paths, chunksize=4)))
+    for i in needs_full:
+        stats.read(items[i][2].st_size)
+    for size in upgrades.values():
+        stats.read(size)
+
+    rehash = [{"path": path, "hash": full_hashes[path]} for path in upgrades if full_hashes.get(path)]
+    if rehash:
+        try:
+            api_post("/files/rehash", json={"files": rehash}, timeout=30)
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Network error sending {len(rehash)} rehashed files: {e}")
+        for entries in seen.values():
+            for e in entries:
+                if e["path"] in upgrades and full_hashes.get(e["path"]):
+                    e["hash"] = full_hashes[e["path"]]
+
+    held = {index: e for index, e in unverified.items()
+            if full_hashes.get(items[index][0]) not in {k["hash"] for k in known[items[index][2].st_size]}}
+    if held:
+        request_rehash([{"device_id": e["device_id"], "path": e["path"]} for e in held.values()])
+
+    results = []
+    full = set(needs_full)
+    for index, ((file_path, file, stat_info), partial) in enumerate(zip(items, partials)):
+        file_hash = full_hashes.get(file_path) if index in full else partial
+        if not file_hash:
+            stats.fail()
+            continue
+        if index in held:
+            logging.warning(f"Unverified duplicate, not sent: {file_path} matches {held[index]['path']} on "
+                            f"{held[index]['device_id']}, which has no full hash yet. A rehash was requested, "
+                            f"the file is sent or reported as a duplicate on the next scan")
+            get_hash_cache().put(stat_info, file_hash)
+            continue
+        if file_hash != partial or stat_info.st_size <= 2 * PARTIAL_HASH_BYTES:
+            get_hash_cache().put(stat_info, file_hash)
+        seen.setdefault(stat_info.st_size, []).append(
+            {"partial_hash": partial, "hash": file_hash, "device_id": DEVICE_ID, "path": file_path})
+        results.append((file_path, file, stat_info, file_hash, partial))
+    return results
+
+
+class ScanStats:
+    """Thread safe files/s and MB/s counters for a scan run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.files = 0
+        self.bytes = 0
+        self.read_bytes = 0
+        self.failed = 0
+
+    def add(self, size):
+        SCAN_FILES.inc()
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            if self.files % SCAN_PROGRESS_EVERY == 0:
+                self.report()
+
+    def read(self, size):
+        SCAN_READ_BYTES.inc(size)
+        with self.lock:
+            self.read_bytes += size
+
+    def fail(self):
+        with self.lock:
+            self.failed += 1
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        mb = self.bytes / (1024 * 1024)
+        read_mb = self.read_bytes / (1024 * 1024)
+        logging.info(f"Scan: {self.files} files ({mb:.1f} MB, {read_mb:.1f} MB read, {self.failed} failed) in {elapsed:.1f}s - "
+                     f"{self.files / elapsed:.1f} files/s, {mb / elapsed:.1f} MB/s")
+
+
+def reconcile_manifest(roots, errors):
+    """Gzip'd NDJSON manifest of every file under roots for /files/reconcile, produced as the walk goes"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    lines = [json.dumps({"device_id": DEVICE_ID, "username": USERNAME,
+                         "roots": [os.path.join(root, "") for root in roots]})]
+    for record in walk_home_directory(roots, errors=errors):
+        if record.path.endswith(ARCHIVE_SUFFIX):
+            # The backend keeps the row of an archived file as it was, size and mtime included
+            lines.append(json.dumps([record.path[:-len(ARCHIVE_SUFFIX)], None, None]))
         else:
-            logging.error(f"Failed to mov {file_data['name']}: {response.text}")
+            lines.append(json.dumps([record.path, record.stat.st_size, record.stat.st_mtime]))
+        if len(lines) >= MANIFEST_CHUNK:
+            chunk = compressor.compress(("\n".join(lines) + "\n").encode())
+            lines = []
+            if chunk:
+                yield chunk
+    # Only a finished walk may prune, files under unreadable paths are kept
+    lines.append(json.dumps({"prune": True, "unreadable": errors}))
+    yield compressor.compress(("\n".join(lines) + "\n").encode()) + compressor.flush()
+
+
+def kept_duplicates(paths):
+    """Paths whose cached hash the backend already stores under another path
+
+    A duplicate the user keeps never gets a row, so reconcile lists it as
+    new on every start. Only files whose hash is cached are checked, nothing
+    is read. With clean_on_scan on they are sent again, so they get removed.
+    """
+    cached = {}
+    for path in paths:
+        try:
+            file_hash = get_hash_cache().get(os.stat(path))
+        except OSError:
+            continue
+        if file_hash:
+            cached[path] = file_hash
+    if not cached:
+        return set()
+
+    try:
+        response = api_post("/files/hashes", json={"username": USERNAME, "hashes": list(set(cached.values()))},
+                            timeout=60)
+        if response.status_code != 200:
+            logging.error(f"Failed to fetch known hashes: {response.text}")
+            return set()
+        result = response.json()
     except requests.exceptions.RequestException as e:
-        logging.error(f"Network error sending {file_data['name']}: {e}")
+        logging.error(f"Network error fetching known hashes: {e}")
+        return set()
+    if result["clean"]:
+        return set()
+    known = set(result["known"])
+    return {path for path, file_hash in cached.items() if file_hash in known}
+
 
-def acc_to_api(filename,dates):
+def reconcile_records(roots):
+    """FileRecords of the files the server has no current copy of, None if it couldn't be asked"""
     try:
-        file_data = {
-                    "device_id": DEVICE_ID,
-                    "username": USERNAME,
-                    "name": filename,
-                    "date": dates
-                }
-        response = requests.post(API_URL+"/acc", json=file_data, timeout=5)
-        if response.status_code == 201:
-            logging.info(f"access: {file_data['name']}")
-        elif response.status_code == 409:
-            logging.info(f" doesnt exists: {file_data['name']}")
-        else:
-            logging.error(f"Failed to update {file_data['name']}: {response.text}")
+        response = api_post("/files/reconcile", data=reconcile_manifest(roots, []), timeout=600,
+                            headers={"Content-Type": "application/x-ndjson", "Content-Encoding": "gzip"})
+        if response.status_code != 200:
+            logging.error(f"Reconcile failed: {response.text}")
+            return None
+        result = response.json()
     except requests.exceptions.RequestException as e:
-        logging.error(f"Network error sending {file_data['name']}: {e}")
+        logging.error(f"Network error during reconcile: {e}")
+        return None
 
+    logging.info(f"Reconcile: {len(result['new'])} new, {len(result['changed'])} changed, "
+                 f"{len(result['gone'])} gone, {result['pruned']} pruned")
+    kept = kept_duplicates(result["new"])
+    if kept:
+        logging.info(f"Reconcile: {len(kept)} new files are duplicates already stored under another path, skipped")
 
-def scan_home_directory():
-    #home_dir = os.path.expanduser("~")
-    #scanned_count = 0
-    home_dir = "/home/shiv/programming/hackathon/smart-file-organiser/test"
+    def records():
+        for path in result["new"] + result["changed"]:
+            if path in kept:
+                continue
+            try:
+                yield FileRecord(path, os.path.basename(path), os.stat(path))
+            except OSError as e:
+                logging.error(f"Error processing {path}: {e}")
+    return records()
 
-    for root, _, files in os.walk(home_dir):
-       
-        if any(folder.startswith('.') or folder in EXCLUDED_DIRS for folder in root.split(os.sep)):
-            continue
 
-        for file in files:
-            if file.startswith('.') or file.startswith('_'):  
-                continue  
+def scan_home_directory(roots=SCAN_ROOTS, profile_output=PROFILE_OUTPUT, **options):
+    if not profile_output:
+        return run_scan(roots, **options)
+    profiler = SamplingProfiler(profile_output).start()
+    try:
+        return run_scan(roots, **options)
+    finally:
+        profiler.stop()
+        logging.info(f"Scan profile written to {profile_output}")
 
-            file_path = os.path.join(root, file)
 
-      
-            if os.path.splitext(file)[1].lower() in EXCLUDED_FILE_TYPES:
-                continue
+def run_scan(roots, hash_workers=HASH_WORKERS, send_workers=SEND_WORKERS, walk_queue_size=WALK_QUEUE_SIZE,
+             send_queue_size=SEND_QUEUE_SIZE, staged_dedupe=STAGED_DEDUPE, reconcile=RECONCILE):
+    # walker -> walk_queue -> hash pool -> send_queue -> sender threads
+    walk_queue = queue.Queue(maxsize=walk_queue_size)
+    send_queue = queue.Queue(maxsize=send_queue_size)
+    stats = ScanStats()
 
-            try:
-              
-                stat_info = os.stat(file_path, follow_symlinks=True)
-                file_size = stat_info.st_size
-                last_access_time = datetime.datetime.fromtimestamp(stat_info.st_atime)
-
-              
-                file_hash = generate_hash(file_path)
-                if not file_hash:
-                    continue  
-
-              
-                category = categorize_file(file)
-
-              
-                file_data = {
-                    "device_id": DEVICE_ID,
-                    "username": USERNAME,
-                    "name": file,
-                    "path": file_path,
-                    "size": file_size,
-                    "hash": file_hash,
-                    "category": category,
-                    "last_access": last_access_time.isoformat()
-                }
-
-              
-                send_to_api(file_data)
-
-              
-                # scanned_count += 1
-                # if scanned_count == 50:
-                #     logging.info(" Scanned 50 files, stopping for now...")
-                #     return
+    # Reconcile first so only new and changed files go through the pipeline, a full walk if that fails
+    records = reconcile_records(roots) if reconcile else None
+    if records is None:
+        records = walk_home_directory(roots)
 
+    def walker():
+        try:
+            for item in records:
+                # Archived files keep the row of the original, they are never hashed
+                if not item.path.endswith(ARCHIVE_SUFFIX):
+                    walk_queue.put(item)
+        finally:
+            walk_queue.put(None)
+
+    def sender():
+        while True:
+            file_data = send_queue.get()
+            if file_data is None:
+                break
+            try:
+                get_upload_batcher().add(file_data)
             except Exception as e:
-                logging.error(f"Error processing {file_path}: {e}")
+                logging.error(f"Error sending {file_data['path']}: {e}")
 
+    senders = [threading.Thread(target=sender, daemon=True) for _ in range(send_workers)]
+    for t in senders:
+        t.start()
+    threading.Thread(target=walker, daemon=True).start()
 
+    # Cap the number of files handed to the pool but not hashed yet
+    in_flight = threading.BoundedSemaphore(walk_queue_size)
 
-class MyHandler(FileSystemEventHandler):
-    def on_created(self, event):
-        file_path = event.src_path
-        file = os.path.basename(file_path)
-
-        # Check if any parent directory is hidden
-        parts = file_path.split(os.sep)  # Split path into parts
-        if any(part.startswith('.') for part in parts):
-            logging.info(f"Excluded: {file_path} (inside hidden directory)")
-            return  
+    def record_hash(file_path, file, stat_info, file_hash):
+        try:
+            if not file_hash:
+                stats.fail()
+                return
+            get_hash_cache().put(stat_info, file_hash)
+            stats.add(stat_info.st_size)
+            stats.read(stat_info.st_size)
+            send_queue.put(build_file_data(file_path, file, stat_info, file_hash))
+        except Exception as e:
+            stats.fail()
+            logging.error(f"Error processing {file_path}: {e}")
+        finally:
+            in_flight.release()
 
-        # Exclude unwanted file types
-        if os.path.splitext(file)[1].lower() in EXCLUDED_FILE_TYPES:
-            logging.info(f"Excluded file type: {file_path}")
-            return 
+    def hashed(future, file_path, file, stat_info):
+        try:
+            file_hash, seconds = future.result()
+            HASH_SECONDS.observe(seconds, kind="sha256")
+        except Exception as e:
+            logging.error(f"Error hashing {file_path}: {e}")
+            file_hash = None
+        record_hash(file_path, file, stat_info, file_hash)
 
-        # Wait to ensure the file is fully written
-        time.sleep(1)
+    images = []
 
+    def hashed_images(future, batch):
+        try:
+            hashes, seconds = future.result()
+            HASH_SECONDS.observe(seconds, kind="phash_batch")
+        except Exception as e:
+            logging.error(f"Error hashing {len(batch)} images: {e}")
+            hashes = [None] * len(batch)
+        for (file_path, file, stat_info), file_hash in zip(batch, hashes):
+            record_hash(file_path, file, stat_info, file_hash)
+
+    def flush_images():
+        # One pool task per batch so the DCT runs over the whole batch at once
+        batch = list(images)
+        images.clear()
+        for _ in batch:
+            in_flight.acquire()
+        future = pool.submit(timed_call, phash_batch, [file_path for file_path, _, _ in batch])
+        future.add_done_callback(lambda f: hashed_images(f, batch))
+
+    staged = []
+    seen = {}
+
+    def flush_staged():
         try:
-            stat_info = os.stat(file_path, follow_symlinks=True)
-            file_size = stat_info.st_size
-            last_access_time = datetime.datetime.fromtimestamp(stat_info.st_atime)
+            for file_path, file, stat_info, file_hash, partial in staged_hashes(pool, staged, seen, stats):
+                stats.add(stat_info.st_size)
+                send_queue.put(build_file_data(file_path, file, stat_info, file_hash, partial))
+        except Exception as e:
+            logging.error(f"Error in staged dedupe of {len(staged)} files: {e}")
+        staged.clear()
 
-            # Generate hash (if file is readable)
-            file_hash = generate_hash(file_path) or "failed"
+    governor = get_governor()
+    with ProcessPoolExecutor(max_workers=hash_workers) as pool:
+        while True:
+            item = walk_queue.get()
+            if item is None:
+                if staged:
+                    flush_staged()
+                if images:
+                    flush_images()
+                break
+            file_path, file, stat_info = item
+
+            # Unchanged since the last scan, skip the pool entirely
+            file_hash = get_hash_cache().get(stat_info)
+            if file_hash:
+                stats.add(stat_info.st_size)
+                send_queue.put(build_file_data(file_path, file, stat_info, file_hash))
+                continue
 
-            category = categorize_file(file)
+            if staged_dedupe and not file_path.lower().endswith(IMAGE_EXTENSIONS):
+                # Only the head and tail are read now, staged_hashes accounts for full hashes
+                governor.acquire(min(stat_info.st_size, 2 * PARTIAL_HASH_BYTES))
+                staged.append(item)
+                if len(staged) >= STAGED_BATCH_SIZE:
+                    flush_staged()
+                continue
 
-            file_data = {
-                "device_id": DEVICE_ID,
-                "username": USERNAME,
-                "name": file,
-                "path": file_path,
-                "size": file_size,
-                "hash": file_hash,
-                "category": category,
-                "last_access": last_access_time.isoformat()
-            }
+            governor.acquire(stat_info.st_size)
+            if file_path.lower().endswith(IMAGE_EXTENSIONS):
+                images.append(item)
+                if len(images) >= PHASH_BATCH:
+                    flush_images()
+                continue
 
-            send_to_api(file_data)
-        except Exception as e:
-            logging.error(f"Failed to process {file_path}: {e}")
-    
-    def on_modified(self, event):
-        """Trigger when a file is opened (read access detected)."""
-        if event.is_directory:
-            return
-        file_path = event.src_path
-        file = os.path.basename(file_path)
-        if file=="scanner.log":
-            return
+            in_flight.acquire()
+            future = pool.submit(timed_call, generate_hash, file_path)
+            future.add_done_callback(lambda f, p=file_path, n=file, s=stat_info: hashed(f, p, n, s))
 
-        # Check if any parent directory is hidden
-        parts = file_path.split(os.sep)  # Split path into parts
-        if any(part.startswith('.') for part in parts):
-            logging.info(f"Excluded: {file_path} (inside hidden directory)")
-            return  
+    get_hash_cache().flush()
 
-        # Exclude unwanted file types
-        if os.path.splitext(file)[1].lower() in EXCLUDED_FILE_TYPES:
-            logging.info(f"Excluded file type: {file_path}")
-            return 
+    for _ in senders:
+        send_queue.put(None)
+    for t in senders:
+        t.join()
+    get_upload_batcher().flush()
 
-        logging.info(f"Access detected: {file_path}")
-        acc_to_api(file,datetime.datetime.now().isoformat())
+    stats.report()
+    return stats
 
-    def on_moved(self, event):
-    
-        src_path = os.path.abspath(event.src_path)  # Ensure absolute path
-        dest_path = os.path.abspath(event.dest_path)  # Ensure absolute path
-        file = os.path.basename(src_path)
 
-    # Check if moved file is in any known trash folder
-        if any(dest_path.startswith(os.path.abspath(trash)) for trash in TRASH_DIRS):
-            logging.info(f"File moved to trash: {file}")
-            del_to_api(file)
-            return
 
-        logging.info(f"File moved: {src_path} → {dest_path}")
-        mov_to_api(file, src_path, dest_path)
+def process_created(file_path):
+    file = os.path.basename(file_path)
+    try:
+        stat_info = os.stat(file_path, follow_symlinks=True)
+        file_size = stat_info.st_size
+        last_access_time = datetime.datetime.fromtimestamp(stat_info.st_atime)
 
+        # Generate hash (if file is readable)
+        file_hash = cached_hash(file_path, stat_info) or "failed"
 
+        category = categorize_file(file)
 
-    def on_deleted(self,event):
-        file_path = event.src_path
-        file = os.path.basename(file_path)
+        file_data = {
+            "device_id": DEVICE_ID,
+            "username": USERNAME,
+            "name": file,
+            "path": file_path,
+            "size": file_size,
+            "hash": file_hash,
+            "category": category,
+            "last_access": last_access_time.isoformat(),
+            "mtime": stat_info.st_mtime
+        }
+
+        send_to_api(file_data)
+    except FileNotFoundError:
+        logging.info(f"Gone before processing: {file_path}")
+    except Exception as e:
+        logging.error(f"Failed to process {file_path}: {e}")
 
-        parts = file_path.split(os.sep)  
-        if any(part.startswith('.') for part in parts):
-            return  
 
-        if os.path.splitext(file)[1].lower() in EXCLUDED_FILE_TYPES:
-            return 
+def process_modified(file_path, when):
+    logging.info(f"Access detected: {file_path}")
+    get_access_coalescer().record(file_path, when)
+
+
+def process_deleted(file_path):
+    try:
+        get_access_coalescer().forget(file_path)
+        del_to_api(file_path)
+    except Exception as e:
+        logging.error(f"Failed to process {file_path}: {e}")
 
-    
-        time.sleep(1)
+
+def process_deleted_dir(dir_path):
+    logging.info(f"Directory deleted: {dir_path}")
+    get_access_coalescer().forget(dir_path, directory=True)
+    del_dir_to_api(dir_path)
+
+
+def process_moved_dir(src_path, dest_path):
+    if any(dest_path.startswith(os.path.abspath(trash)) for trash in TRASH_DIRS):
+        process_deleted_dir(src_path)
+        return
+    logging.info(f"Directory moved: {src_path} → {dest_path}")
+    get_access_coalescer().moved(src_path, dest_path, directory=True)
+    mov_dir_to_api(src_path, dest_path)
+
+
+def process_moved(src_path, dest_path):
+    file = os.path.basename(src_path)
+
+    # Check if moved file is in any known trash folder
+    if any(dest_path.startswith(os.path.abspath(trash)) for trash in TRASH_DIRS):
+        logging.info(f"File moved to trash: {file}")
+        get_access_coalescer().forget(src_path)
+        del_to_api(src_path)
+        return
+
+    logging.info(f"File moved: {src_path} → {dest_path}")
+    get_access_coalescer().moved(src_path, dest_path)
+    mov_to_api(file, src_path, dest_path)
+
+
+class EventCoalescer:
+    """Collects watchdog events per path and hands them to workers once they settle
+
+    Handlers only record events here. An event is processed after its path
+    has been quiet for quiet_period seconds, and only its net effect is
+    processed: a file that is created, written and deleted inside the
+    window produces no hashing and no HTTP at all. A directory move or
+    delete absorbs the pending events of the files below it, so removing
+    a folder is one request rather than one per file.
+
+    Events that touch the same path (or a directory and a path below it)
+    are processed one at a time in the order they settled. A later event
+    waits while an earlier one is still being processed.
+    """
+
+    def __init__(self, quiet_period=EVENT_QUIET_PERIOD, workers=EVENT_WORKERS):
+        self.quiet_period = quiet_period
+        self.lock = threading.Lock()
+        self.pending = {}  # path -> [kind, src_path, event time, last seen]
+        self.in_flight = set()  # paths of events handed to a worker and not finished yet
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.stopped = threading.Event()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+
+    def record(self, kind, path, dest_path=None):
+        now = time.monotonic()
+        when = datetime.datetime.now()
+        with self.lock:
+            current = self.pending.get(path)
+            if kind == "created":
+                self.pending[path] = ["created", None, when, now]
+            elif kind == "modified":
+                if current and current[0] in ("created", "moved"):
+                    current[3] = now  # still being written, keep waiting
+                else:
+                    self.pending[path] = ["modified", None, when, now]
+            elif kind == "deleted":
+                if current and current[0] == "created":
+                    del self.pending[path]  # never reported, nothing to undo
+                elif current and current[0] == "moved":
+                    self.pending[path] = ["deleted", current[1], when, now]
+                else:
+                    self.pending[path] = ["deleted", None, when, now]
+            elif kind == "moved":
+                current = self.pending.pop(path, None)
+                if current and current[0] == "created":
+                    self.pending[dest_path] = ["created", None, when, now]
+                else:
+                    src_path = current[1] if current and current[0] == "moved" else path
+                    self.pending[dest_path] = ["moved", src_path, when, now]
+            elif kind == "moved_dir":
+                # Pending events below the directory now happen under its new path
+                src_prefix, dest_prefix = os.path.join(path, ""), os.path.join(dest_path, "")
+                for key in [key for key in self.pending if key.startswith(src_prefix)]:
+                    self.pending[dest_prefix + key[len(src_prefix):]] = self.pending.pop(key)
+                current = self.pending.pop(path, None)
+                src_path = current[1] if current and current[0] == "moved_dir" else path
+                self.pending[dest_path] = ["moved_dir", src_path, when, now]
+            elif kind == "deleted_dir":
+                prefix = os.path.join(path, "")
+                for key in [key for key in self.pending if key.startswith(prefix)]:
+                    entry = self.pending.pop(key)
+                    if entry[0] == "moved" and not entry[1].startswith(prefix):
+                        # Moved in from elsewhere before the delete, its row is still at the old path
+                        self.pending[entry[1]] = ["deleted", None, when, now]
+                current = self.pending.get(path)
+                src_path = current[1] if current and current[0] == "moved_dir" else None
+                self.pending[path] = ["deleted_dir", src_path, when, now]
+
+    @staticmethod
+    def _overlaps(path, other):
+        return path == other or path.startswith(os.path.join(other, "")) or other.startswith(os.path.join(path, ""))
+
+    def _dispatch(self):
+        while not self.stopped.wait(self.quiet_period / 4):
+            now = time.monotonic()
+            settled = []
+            with self.lock:
+                candidates = sorted((entry[2], path) for path, entry in self.pending.items()
+                                    if now - entry[3] >= self.quiet_period)
+                for _, path in candidates:
+                    entry = self.pending[path]
+                    touched = {path, entry[1]} - {None}
+                    # Stays pending until the worker on an overlapping path is done, e.g. a slow
+                    # created hash must reach the outbox before the move or delete that followed it
+                    if any(self._overlaps(p, busy) for p in touched for busy in self.in_flight):
+                        continue
+                    del self.pending[path]
+                    self.in_flight.update(touched)
+                    settled.append((path, entry, touched))
+            for path, (kind, src_path, when, _), touched in settled:
+                self.pool.submit(self._process, kind, path, src_path, when, touched)
+
+    def _process(self, kind, path, src_path, when, touched=()):
         try:
-            del_to_api(file)
+            self._handle(kind, path, src_path, when)
+        finally:
+            with self.lock:
+                self.in_flight.difference_update(touched)
+
+    def _handle(self, kind, path, src_path, when):
+        try:
+            if kind == "created":
+                process_created(path)
+            elif kind == "modified":
+                process_modified(path, when)
+            elif kind == "deleted":
+                process_deleted(src_path or path)
+            elif kind == "moved":
+                process_moved(src_path, path)
+            elif kind == "moved_dir":
+                process_moved_dir(src_path, path)
+            elif kind == "deleted_dir":
+                process_deleted_dir(src_path or path)
         except Exception as e:
-            logging.error(f"Failed to process {file_path}: {e}")
+            logging.error(f"Failed to process {kind} event for {path}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.pool.shutdown(wait=True)
+
+
+class OwnChanges:
+    """Paths the agent itself is rewriting, which the watcher must not report
+
+    Archiving replaces a file with its compressed copy and deletes the
+    original. The backend hears about that through /archive/report, not as
+    a delete. Paths stay ignored for grace seconds after the change, so
+    events delivered late are dropped too.
+    """
+
+    def __init__(self, grace=OWN_CHANGE_GRACE):
+        self.grace = grace
+        self.lock = threading.Lock()
+        self.paths = {}  # path -> [changes in progress, time the last one finished]
+
+    @contextmanager
+    def expect(self, *paths):
+        with self.lock:
+            for path in paths:
+                self.paths.setdefault(path, [0, 0.0])[0] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                for path in paths:
+                    self.paths[path][0] -= 1
+                    self.paths[path][1] = time.monotonic()
+
+    def __contains__(self, path):
+        with self.lock:
+            state = self.paths.get(path)
+            if state is None:
+                return False
+            if state[0] or time.monotonic() - state[1] < self.grace:
+                return True
+            del self.paths[path]
+            return False
+
+
+own_changes = OwnChanges()
+
+
+def is_watched(file_path, directory=False):
+    file = os.path.basename(file_path)
+    if file == "scanner.log" or file.endswith(ARCHIVE_SUFFIX):
+        return False
+    if file_path in own_changes:
+        return False
+
+    # Same filters as the walk, or reconcile would prune what the watcher stored
+    return should_scan_path(file_path, directory)
+
+
+class MyHandler(FileSystemEventHandler):
+    # Handlers only enqueue, all hashing and HTTP happens on the coalescer's workers
+    def __init__(self, coalescer):
+        super().__init__()
+        self.coalescer = coalescer
+
+    def on_created(self, event):
+        if event.is_directory or not is_watched(event.src_path):
+            return
+        self.coalescer.record("created", event.src_path)
+
+    def on_modified(self, event):
+        """Trigger when a file is opened (read access detected)."""
+        if event.is_directory or not is_watched(event.src_path):
+            return
+        self.coalescer.record("modified", event.src_path)
+
+    def on_moved(self, event):
+        if event.is_synthetic:
+            return  # a file inside a moved directory, covered by the directory's own event
+        src_path = os.path.abspath(event.src_path)  # Ensure absolute path
+        dest_path = os.path.abspath(event.dest_path)  # Ensure absolute path
+        src_watched = is_watched(src_path, event.is_directory)
+        dest_watched = is_watched(dest_path, event.is_directory)
+        if not src_watched and not dest_watched:
+            return  # e.g. an archive's temporary file renamed into place
+        if not dest_watched:
+            # Moved somewhere a scan doesn't look (trash, a hidden or excluded folder), same as deleted
+            self.coalescer.record("deleted_dir" if event.is_directory else "deleted", src_path)
+        elif not src_watched and not event.is_directory:
+            self.coalescer.record("created", dest_path)
+        else:
+            self.coalescer.record("moved_dir" if event.is_directory else "moved", src_path, dest_path)
+
+    def on_deleted(self, event):
+        if not is_watched(event.src_path, event.is_directory):
+            return
+        self.coalescer.record("deleted_dir" if event.is_directory else "deleted", event.src_path)
 
 
 def monitor():
-    event_handler = MyHandler()
+    coalescer = EventCoalescer()
+    event_handler = MyHandler(coalescer)
     observer = Observer()
     observer.schedule(event_handler,os.path.expanduser("~"),recursive=True)
     observer.start()
@@ -374,86 +2186,454 @@ def monitor():
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    coalescer.stop()
+    get_access_coalescer().flush()
 
         
 
 
 
 TASKS_API = API_URL + "/tasks"
+CLAIM_TASKS_API = API_URL + "/tasks/claim"
+EXTEND_TASKS_API = API_URL + "/tasks/extend"
 COMPLETE_TASK_API = API_URL + "/task/done"
+COMPLETE_TASKS_API = API_URL + "/task/done/batch"
+FAIL_TASKS_API = API_URL + "/task/failed"
+
+TASK_CLAIM_MAX = int(os.getenv("task_claim_max", 10))
+TASK_LEASE_SECONDS = int(os.getenv("task_lease_seconds", 300))
+TASK_LONG_POLL = 25
+TASK_MAX_IN_FLIGHT = int(os.getenv("task_max_in_flight", 100))
+TASK_CONCURRENCY = {
+    "sync": int(os.getenv("sync_workers", 4)),
+    "archive": int(os.getenv("archive_workers", 2)),
+    "unarchive": int(os.getenv("unarchive_workers", 2)),
+}
+TASK_ACK_BATCH = 100
+TASK_ACK_INTERVAL = 2
+TASK_STATS_INTERVAL = 60
+
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+GZIP_MAGIC = b"\x1f\x8b"
+
+archive_bucket = None  # per pool process, set by init_archive_worker
+
+
+def init_archive_worker(rate):
+    global archive_bucket
+    archive_bucket = TokenBucket(rate, max(rate, ARCHIVE_CHUNK)) if rate else None
+
+
+def archive_throttle(amount):
+    if archive_bucket:
+        archive_bucket.acquire(amount)
+
+
+def archive_compressor(codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("archive_codec is zstd but the zstandard package is not installed")
+        return zstandard.ZstdCompressor(level=ARCHIVE_LEVEL).compressobj()
+    return zlib.compressobj(ARCHIVE_LEVEL, zlib.DEFLATED, 31)
+
+
+def archive_codec_of(path):
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    if magic[:2] == GZIP_MAGIC:
+        return "gzip"
+    return None  # renamed, not compressed, by agents before archives were compressed
+
+
+def read_decompressed(f, codec):
+    """Yield the decompressed contents of f, at most ARCHIVE_CHUNK bytes at a time"""
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Archive is zstd compressed but the zstandard package is not installed")
+        yield from zstandard.ZstdDecompressor().read_to_iter(f, read_size=ARCHIVE_CHUNK, write_size=ARCHIVE_CHUNK)
+        return
+    decompressor = zlib.decompressobj(31)
+    while data := f.read(ARCHIVE_CHUNK):
+        # max_length keeps a highly compressible file from expanding in memory all at once
+        while data:
+            yield decompressor.decompress(data, ARCHIVE_CHUNK)
+            data = decompressor.unconsumed_tail
+    yield decompressor.flush()
+    if not decompressor.eof:
+        raise ValueError("Archive is truncated")
+
+
+def check_stored_hash(path, size, sha256, stored_hash):
+    """Raise if the file's SHA-256 doesn't match the hash the backend has for it
+
+    Images are stored with a phash and files hashed with staged_dedupe may
+    have a partial hash, those are checked as far as they can be.
+    """
+    if not stored_hash or len(stored_hash) != 64:
+        return
+    if stored_hash != sha256 and stored_hash != partial_hash(path, size):
+        raise ValueError(f"{path} does not match its stored hash")
+
 
-def process_task(task):
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # directories can't be opened on Windows
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def temp_path_for(path):
+    # Hidden, so neither the scanner nor the watcher pick it up
+    return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}{ARCHIVE_SUFFIX}.partial")
+
+
+def compress_file(path, stored_hash, codec=ARCHIVE_CODEC):
+    """Replace path with a compressed path + ARCHIVE_SUFFIX, returns its size
+
+    Runs in a pool process. The file is streamed through the compressor in
+    ARCHIVE_CHUNK pieces, so memory stays bounded whatever its size. The
+    archive is decompressed again and compared against the original's
+    SHA-256 before it takes the original's place. Returns None, and keeps
+    the original, if compression doesn't make the file smaller.
+    """
+    before = os.stat(path)
+    temp = temp_path_for(path)
+    hasher = hashlib.sha256()
+    compressor = archive_compressor(codec)
+    try:
+        with open(path, "rb") as src, open(temp, "wb") as out:
+            while chunk := src.read(ARCHIVE_CHUNK):
+                archive_throttle(len(chunk))
+                hasher.update(chunk)
+                out.write(compressor.compress(chunk))
+            out.write(compressor.flush())
+            out.flush()
+            os.fsync(out.fileno())
+        after = os.stat(path)
+        if (after.st_size, after.st_mtime_ns) != (before.st_size, before.st_mtime_ns):
+            raise ValueError(f"{path} changed while it was being archived")
+        sha256 = hasher.hexdigest()
+        check_stored_hash(path, before.st_size, sha256, stored_hash)
+
+        archived_size = os.path.getsize(temp)
+        if archived_size >= before.st_size:
+            os.remove(temp)
+            return None
+
+        verifier = hashlib.sha256()
+        with open(temp, "rb") as f:
+            for chunk in read_decompressed(f, codec):
+                verifier.update(chunk)
+        if verifier.hexdigest() != sha256:
+            raise ValueError(f"Archive of {path} failed verification")
+
+        shutil.copystat(path, temp)
+        os.replace(temp, path + ARCHIVE_SUFFIX)
+        fsync_dir(os.path.dirname(path) or ".")
+        os.remove(path)
+        return archived_size
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def decompress_file(path, stored_hash):
+    """Restore path from path + ARCHIVE_SUFFIX, streaming it back out in ARCHIVE_CHUNK pieces"""
+    archived = path + ARCHIVE_SUFFIX
+    codec = archive_codec_of(archived)
+    if codec is None:
+        os.replace(archived, path)
+        return
+
+    temp = temp_path_for(path)
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with open(archived, "rb") as src, open(temp, "wb") as out:
+            for chunk in read_decompressed(src, codec):
+                archive_throttle(len(chunk))
+                hasher.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        check_stored_hash(temp, size, hasher.hexdigest(), stored_hash)
+
+        shutil.copystat(archived, temp)
+        os.replace(temp, path)
+        fsync_dir(os.path.dirname(path) or ".")
+        os.remove(archived)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+archive_pool = None
+archive_pool_lock = threading.Lock()
+
+
+def get_archive_pool():
+    global archive_pool
+    with archive_pool_lock:
+        if archive_pool is None:
+            # Each process gets an equal share of the I/O budget
+            archive_pool = ProcessPoolExecutor(max_workers=ARCHIVE_PROCESSES, initializer=init_archive_worker,
+                                               initargs=(ARCHIVE_IO_RATE / ARCHIVE_PROCESSES,))
+        return archive_pool
+
+
+def archive_report(path, action, archived_size=None):
+    get_outbox().append("archive_report", {
+        "device_id": DEVICE_ID,
+        "username": USERNAME,
+        "path": path,
+        "action": action,
+        "archived_size": archived_size
+    })
+
+
+def archive(task):
+    path = task["path"]
+    archived = path + ARCHIVE_SUFFIX
+    with own_changes.expect(path, archived):
+        if not os.path.exists(path) and os.path.exists(archived):
+            # Done before, the report may not have been sent
+            archive_report(path, "archive", os.path.getsize(archived))
+            return
+        get_governor().acquire(os.path.getsize(path))
+        archived_size = get_archive_pool().submit(compress_file, path, task.get("hash")).result()
+    if archived_size is None:
+        logging.info(f"Not archiving {path}, it doesn't compress")
+        # Clears the file's archive flag, otherwise it is never considered again
+        archive_report(path, "skipped")
+        return
+    logging.info(f"Archived {path}, {archived_size} bytes on disk")
+    archive_report(path, "archive", archived_size)
+
+
+def unarchive(task):
+    path = task["path"]
+    archived = path + ARCHIVE_SUFFIX
+    with own_changes.expect(path, archived):
+        if os.path.exists(archived):
+            get_governor().acquire(os.path.getsize(archived))
+            get_archive_pool().submit(decompress_file, path, task.get("hash")).result()
+        elif not os.path.exists(path):
+            raise FileNotFoundError(f"Neither {path} nor its archive exist")
+    logging.info(f"Unarchived {path}")
+    archive_report(path, "unarchive")
+
+
+def rehash(task):
+    """Full hash of a file stored with only a partial hash, requested by another device's scan"""
+    path = task["path"]
+    get_governor().acquire(os.path.getsize(path))
+    file_hash = generate_hash(path)
+    if not file_hash:
+        raise OSError(f"Could not hash {path}")
+    response = api_post("/files/rehash", json={"files": [{"path": path, "hash": file_hash}]}, timeout=30)
+    response.raise_for_status()
+    logging.info(f"Rehashed {path}: {response.json()['results'][0]['status']}")
+
+
+def run_task(task):
     print(f"Processing {task['action']} for {task['path']}")
-    
+
     if task["action"] == "sync":
         upload_file(task["path"])
     elif task["action"] == "archive":
-        os.rename(task["path"], task["path"] + ".archived")
-
-    # Mark task as done
-    requests.post(COMPLETE_TASK_API + f"/{task['id']}")
-
-def poll_tasks():
-    while True:
+        archive(task)
+    elif task["action"] == "unarchive":
+        unarchive(task)
+    elif task["action"] == "rehash":
+        rehash(task)
+
+
+class TaskExecutor:
+    """Runs claimed tasks on long-lived per-action thread pools
+
+    At most max_in_flight tasks are queued or running at once, the poller
+    waits for a free slot before claiming more. Finished tasks are acked to
+    /task/done/batch in batches and failed ones to /task/failed, which retries
+    them after a backoff or gives up. Leases of every claimed task (queued,
+    running or waiting for its ack) are renewed until the ack is sent.
+    """
+
+    def __init__(self, concurrency=TASK_CONCURRENCY, max_in_flight=TASK_MAX_IN_FLIGHT):
+        self.pools = {action: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"task-{action}")
+                      for action, workers in concurrency.items()}
+        self.default_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="task-other")
+        self.max_in_flight = max_in_flight
+        self.slots = threading.Condition()
+        self.lock = threading.Lock()
+        self.queued = {}    # action -> tasks waiting for a worker
+        self.running = {}   # task id -> action
+        self.leased = set()  # claimed task ids not acked yet
+        self.latency = {}   # action -> [count, total seconds, max seconds]
+        self.failed = 0
+        self.acks = []
+        self.failures = []
+        threading.Thread(target=self._ack_periodically, daemon=True).start()
+        threading.Thread(target=self._extend_leases, daemon=True).start()
+        threading.Thread(target=self._log_stats, daemon=True).start()
+
+    def in_flight(self):
+        with self.lock:
+            return sum(self.queued.values()) + len(self.running)
+
+    def wait_for_slots(self):
+        """Block until a task can be accepted, returns the number of free slots"""
+        with self.slots:
+            while True:
+                free = self.max_in_flight - self.in_flight()
+                if free > 0:
+                    return free
+                self.slots.wait()
+
+    def submit(self, task):
+        action = task["action"]
+        with self.lock:
+            self.leased.add(task["id"])
+            self.queued[action] = self.queued.get(action, 0) + 1
+            TASK_QUEUE_DEPTH.set(self.queued[action], action=action)
+        self.pools.get(action, self.default_pool).submit(self._run, task)
+
+    def _run(self, task):
+        action = task["action"]
+        with self.lock:
+            self.queued[action] -= 1
+            TASK_QUEUE_DEPTH.set(self.queued[action], action=action)
+            self.running[task["id"]] = action
+        start = time.monotonic()
         try:
-            response = requests.get(TASKS_API)
-            tasks = response.json()
-
-            if tasks:
-                threads = []
-                for task in tasks:
-                    t = threading.Thread(target=process_task, args=(task,))
-                    t.start()
-                    threads.append(t)
-                
-                for t in threads:
-                    t.join()
+            run_task(task)
+            ok = True
         except Exception as e:
-            print(f"Error fetching tasks: {e}")
-        
-        time.sleep(5)
+            logging.error(f"Task {task['id']} ({action} {task['path']}) failed: {e}")
+            ok = False
+        elapsed = time.monotonic() - start
+        TASK_SECONDS.observe(elapsed, action=action)
+        with self.lock:
+            del self.running[task["id"]]
+            stats = self.latency.setdefault(action, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            if ok:
+                self.acks.append(task["id"])
+                flush = len(self.acks) >= TASK_ACK_BATCH
+            else:
+                self.failures.append(task["id"])
+                self.failed += 1
+                flush = False
+        if flush:
+            self.flush_acks()
+        with self.slots:
+            self.slots.notify_all()
+
+    def flush_acks(self):
+        with self.lock:
+            ids, self.acks = self.acks, []
+            failures, self.failures = self.failures, []
+        if ids and not self._report(COMPLETE_TASKS_API, {"ids": ids}, ids, "ack"):
+            with self.lock:
+                self.acks.extend(ids)
+        if failures and not self._report(FAIL_TASKS_API, {"device_id": DEVICE_ID, "ids": failures}, failures,
+                                         "report failure of"):
+            with self.lock:
+                self.failures.extend(failures)
+
+    def _report(self, url, body, ids, what):
+        try:
+            response = requests.post(url, json=body, timeout=30)
+            if response.status_code == 200:
+                with self.lock:
+                    self.leased.difference_update(ids)
+                return True
+            logging.error(f"Failed to {what} {len(ids)} tasks: {response.text}")
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Network error trying to {what} {len(ids)} tasks: {e}")
+        return False
+
+    def _ack_periodically(self):
+        while True:
+            time.sleep(TASK_ACK_INTERVAL)
+            self.flush_acks()
+
+    def _extend_leases(self):
+        while True:
+            time.sleep(TASK_LEASE_SECONDS / 3)
+            with self.lock:
+                ids = list(self.leased)
+            if not ids:
+                continue
+            try:
+                requests.post(EXTEND_TASKS_API, json={"device_id": DEVICE_ID, "ids": ids, "lease": TASK_LEASE_SECONDS},
+                              timeout=10)
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Network error extending task leases: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": dict(self.queued),
+                "running": len(self.running),
+                "pending_acks": len(self.acks),
+                "pending_failures": len(self.failures),
+                "failed": self.failed,
+                "latency": {action: {"count": count, "avg": total / count if count else 0.0, "max": peak}
+                            for action, (count, total, peak) in self.latency.items()}
+            }
+
+    def _log_stats(self):
+        while True:
+            time.sleep(TASK_STATS_INTERVAL)
+            logging.info(f"Tasks: {json.dumps(self.stats())}")
+
+
+task_executor = None
 
 
-def archive_old_files():
+def poll_tasks():
+    global task_executor
+    task_executor = TaskExecutor()
     while True:
         try:
-            home_dir = "/home/shiv/programming/hackathon/smart-file-organiser/test"  # Change as needed
-            cutoff_date = datetime.datetime.now() - datetime.timedelta(days=30)
-
-            for root, _, files in os.walk(home_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    
-                    try:
-                        stat_info = os.stat(file_path, follow_symlinks=True)
-                        last_access_time = datetime.datetime.fromtimestamp(stat_info.st_atime)
-                        
-                        if last_access_time < cutoff_date:
-                            logging.info(f"Archiving: {file_path}")
-                            task_data = {
-                                "device_id": DEVICE_ID,
-                                "username": USERNAME,
-                                "action": "archive",
-                                "path": file_path
-                            }
-                            response = requests.post(API_URL+"/task", json=task_data, timeout=5)
-                            if response.status_code == 201:
-                                logging.info(f"Sent archive task for: {file_path}")
-                            else:
-                                logging.error(f"Failed to send archive task for {file_path}: {response.text}")
-                    except Exception as e:
-                        logging.error(f"Error processing {file_path}: {e}")
+            free = task_executor.wait_for_slots()
 
+            # Long-poll: the server holds the request until tasks for this device are queued
+            response = requests.post(CLAIM_TASKS_API, json={
+                "device_id": DEVICE_ID,
+                "max": min(TASK_CLAIM_MAX, free),
+                "lease": TASK_LEASE_SECONDS,
+                "wait": TASK_LONG_POLL
+            }, timeout=TASK_LONG_POLL + 10)
+            tasks = response.json()["tasks"]
+
+            for task in tasks:
+                task_executor.submit(task)
         except Exception as e:
-            logging.error(f"Error in archive thread: {e}")
-        
-        time.sleep(21600) 
+            print(f"Error fetching tasks: {e}")
+            time.sleep(5)
 
 
 if __name__ == '__main__':
+    apply_priority()
+    if METRICS_PORT:
+        metrics.serve(int(METRICS_PORT))
+    # Replays events left over from the last run while the scan goes
+    get_outbox()
     scan_home_directory()
     threading.Thread(target=poll_tasks, daemon=True).start()
-    threading.Thread(target=archive_old_files, daemon=True).start()
     monitor()
 
 